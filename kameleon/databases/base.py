@@ -50,6 +50,58 @@ class Database(object):
     def close(self):
         yield self._close()
 
+    def pool_stats(self):
+        """
+        Connection pool statistics (in use, idle, waiters, acquire latency).
+        None if the database does not use a pool
+        """
+        return None
+
+    def sql_cache_stats(self, model_class):
+        """
+        Statistics of the generated SQL cache of a model (size, hits, misses,
+        evictions). None if no query of the model was generated
+        """
+        return None
+
+    def result_cache_stats(self):
+        """
+        Statistics of the query result cache (size, hits, misses, evictions,
+        expirations, invalidations). None if the database does not cache
+        """
+        return None
+
+    def watch(self, model_class):
+        """
+        Follow the changes made to the table of model_class by other
+        processes. Not supported by default
+        """
+        pass
+
+    def observe(self, model):
+        """
+        Refresh a live model when its row changes. Not supported by default
+        """
+        pass
+
+    def propagate(self, model, fields=None):
+        """
+        Apply the saved fields of model to its other live instances
+        """
+        pass
+
+    def invalidate(self, model_class, cascade=False):
+        """
+        Drop the cached results reading the table of model_class
+        """
+        pass
+
+    def runCachedQuery(self, tables, ttl, query, params=None):
+        """
+        Run a query which results may be cached. Not cached by default
+        """
+        return self.runQuery(query, params)
+
     @inlineCallbacks
     def runOperation(self, *args, **kwargs):
         """
@@ -63,3 +115,26 @@ class Database(object):
         Run an query on the Database. The database send an answer back
         """
         raise NotImplementedError('Run query not implemented')
+
+    @inlineCallbacks
+    def runInteraction(self, *args, **kwargs):
+        """
+        Run a function in a transaction. The function receives a cursor
+        """
+        raise NotImplementedError('Run interaction not implemented')
+
+    @inlineCallbacks
+    def runStream(self, *args, **kwargs):
+        """
+        Run a function in a transaction on a connection the other queries do
+        not wait for. The function receives a cursor
+        """
+        raise NotImplementedError('Run stream not implemented')
+
+    @inlineCallbacks
+    def transaction(self, func, *args, **kwargs):
+        """
+        Run a function in a transaction. The function receives a database
+        to give to the queries to run in the transaction
+        """
+        raise NotImplementedError('Transaction not implemented')
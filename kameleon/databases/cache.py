@@ -0,0 +1,221 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections, copy, time
+
+def freeze(value):
+    """
+    Hashable version of query params
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
+
+def copy_rows(rows, mutable=True):
+    """
+    Copy of rows. Mutable values (json, arrays) are copied too, so models
+    loaded from the rows cannot change them
+    """
+    if not mutable:
+        return list(rows)
+    return [tuple(copy.deepcopy(x) if isinstance(x, (dict, list)) else x for x in row)
+            for row in rows]
+
+def copy_values(values):
+    """
+    Copy of a dict of values. Mutable values are copied too, see copy_rows
+    """
+    return dict([(k, copy.deepcopy(v) if isinstance(v, (dict, list)) else v)
+                 for k, v in values.items()])
+
+def has_mutable(rows):
+    for row in rows:
+        for value in row:
+            if isinstance(value, (dict, list)):
+                return True
+    return False
+
+class LRUCache(object):
+    """
+    Mapping keeping at most max_size entries. When full, the least recently
+    used entry is evicted.
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        # Mark as most recently used
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Add an entry. Returns the list of (key, value) evicted to make room
+        """
+        self.entries.pop(key, None)
+        self.entries[key] = value
+
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted.append(self.entries.popitem(last=False))
+            self.evictions += 1
+        return evicted
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+class ResultCache(object):
+    """
+    Rows returned by queries, keyed by SQL and params. Entries expire after
+    their time to live, the least recently used are evicted when full, and
+    every entry reading a table is dropped when that table is written.
+    """
+
+    def __init__(self, max_size=1024, clock=time.time):
+        self.entries = LRUCache(max_size)
+        self.clock = clock
+
+        # Keys of the entries reading each table
+        self.tables = {}
+
+        # Number of writes of each table. A query only stores its rows if
+        # none of its tables were written while it ran
+        self.generations = {}
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def generation(self, tables):
+        return tuple(self.generations.get(x, 0) for x in tables)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires, tables, rows, mutable = entry
+        if expires <= self.clock():
+            self._remove(key, tables)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return copy_rows(rows, mutable)
+
+    def set(self, key, rows, tables, ttl, generation):
+        """
+        Store a copy of rows read from tables at generation. Ignored if one
+        of the tables was written since
+        """
+        if generation != self.generation(tables):
+            return
+
+        mutable = has_mutable(rows)
+        entry = (self.clock() + ttl, tables, copy_rows(rows, mutable), mutable)
+        for evicted_key, evicted in self.entries.set(key, entry):
+            self._unindex(evicted_key, evicted[1])
+            self.evictions += 1
+
+        for table in tables:
+            self.tables.setdefault(table, set()).add(key)
+
+    def invalidate(self, table):
+        """
+        Drop every entry reading table
+        """
+        self.generations[table] = self.generations.get(table, 0) + 1
+        for key in self.tables.pop(table, ()):
+            entry = self.entries.pop(key)
+            if entry is not None:
+                self._unindex(key, entry[1])
+                self.invalidations += 1
+
+    def clear(self):
+        for table in list(self.tables):
+            self.invalidate(table)
+
+    def _remove(self, key, tables):
+        self.entries.pop(key)
+        self._unindex(key, tables)
+
+    def _unindex(self, key, tables):
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "max_size": self.entries.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations
+        }
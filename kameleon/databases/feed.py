@@ -0,0 +1,201 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json, weakref
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+
+from cache import copy_values
+
+# Channel notified by the trigger of a table is this prefix followed by the
+# table name
+CHANNEL_PREFIX = "kameleon_"
+
+class InstanceRef(weakref.ref):
+    """
+    Weak reference to an instance remembering the id it is registered with
+    """
+    __slots__ = ("id",)
+
+class InstanceRegistry(object):
+    """
+    Live instances of a model by id. They are held through weak references
+    so being registered does not keep them alive
+    """
+
+    def __init__(self):
+        # Set of weak references to the instances, by id
+        self.instances = {}
+
+    def add(self, id, model):
+        refs = self.instances.get(id)
+        if refs is None:
+            refs = self.instances[id] = set()
+        ref = InstanceRef(model, self._discard)
+        ref.id = id
+        refs.add(ref)
+
+    def _discard(self, ref):
+        refs = self.instances.get(ref.id)
+        if refs is not None:
+            refs.discard(ref)
+            if not refs:
+                del self.instances[ref.id]
+
+    def get(self, id):
+        models = []
+        for ref in list(self.instances.get(id, ())):
+            model = ref()
+            if model is not None:
+                models.append(model)
+        return models
+
+    def __contains__(self, id):
+        return id in self.instances
+
+    def __len__(self):
+        return len(self.instances)
+
+class ChangeFeed(object):
+    """
+    Changes made to the watched tables by other processes. A trigger on each
+    table notifies the operation and the id of the changed rows, which are
+    received through LISTEN on a dedicated connection. Cached results of the
+    table are dropped, live instances of an updated row are refreshed and
+    the handlers of the model are called.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+        # Connection listening to the channels. None until started
+        self.connection = None
+
+        # Model watched on each channel
+        self.models = {}
+
+        # Functions called with (model class, operation, id) on each change
+        # of a table. The id is None if the trigger is per statement
+        self.handlers = {}
+
+        # Registry of the live instances refreshed when their row is
+        # updated, by table
+        self.observers = {}
+
+    def channel(self, model_class):
+        return CHANNEL_PREFIX + model_class._meta.table_name
+
+    def watch(self, model_class):
+        """
+        Follow the changes of the table of model_class. Returns a Deferred if
+        the feed is already listening
+        """
+        channel = self.channel(model_class)
+        self.models[channel] = model_class
+        if self.connection is not None:
+            return self.connection.runOperation("LISTEN {0};".format(channel))
+
+    @inlineCallbacks
+    def start(self, connection):
+        """
+        Listen on connection to the channels of every watched model. They are
+        listened again if the connection is recovered
+        """
+        self.connection = connection
+        self.connection.addNotifyObserver(self.notified)
+        self.connection.detector.addRecoveryHandler(self.listen)
+        yield self.listen()
+
+    @inlineCallbacks
+    def listen(self):
+        for channel in list(self.models):
+            yield self.connection.runOperation("LISTEN {0};".format(channel))
+
+    @inlineCallbacks
+    def stop(self):
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            connection.removeNotifyObserver(self.notified)
+            yield connection.close()
+
+    def add_handler(self, model_class, handler):
+        """
+        Call handler(model_class, operation, id) whenever another process
+        inserts, updates or deletes rows of model_class
+        """
+        self.handlers.setdefault(model_class._meta.table_name, []).append(handler)
+
+    def remove_handler(self, model_class, handler):
+        handlers = self.handlers.get(model_class._meta.table_name, [])
+        if handler in handlers:
+            handlers.remove(handler)
+
+    def observe(self, model):
+        """
+        Refresh model whenever its row is updated, as long as it is alive
+        """
+        table = model._meta.table_name
+        if table not in self.observers:
+            self.observers[table] = InstanceRegistry()
+        self.observers[table].add(model.id, model)
+
+    def publish(self, model_class, values, source=None):
+        """
+        Apply values, a dict holding the id of the row, to the live instances
+        of the row other than source. Each gets its own copy of mutable
+        values, so changing one in place does not change the others
+        """
+        registry = self.observers.get(model_class._meta.table_name)
+        if registry is None:
+            return
+
+        for model in registry.get(values["id"]):
+            if model is not source:
+                model.propagate_update(copy_values(values))
+
+    @inlineCallbacks
+    def notified(self, notify):
+        model_class = self.models.get(notify.channel)
+        if model_class is None:
+            return
+
+        # Writes of this process already invalidated and propagated
+        if notify.pid in self.database.backend_pids:
+            return
+
+        payload = json.loads(notify.payload)
+        operation, id = payload["op"], payload["id"]
+
+        # Rows of the tables referencing a deleted row may be deleted too
+        self.database.invalidate(model_class, cascade=operation == "DELETE")
+
+        registry = self.observers.get(model_class._meta.table_name)
+        if operation == "UPDATE" and registry is not None and id in registry:
+            rows = yield self.database.runQuery("SELECT * FROM {0} WHERE id = %s;"
+                                                .format(model_class._meta.table_name), (id,))
+            if rows:
+                self.publish(model_class, dict(zip(model_class._meta.sorted_fields_names, rows[0])))
+
+        for handler in list(self.handlers.get(model_class._meta.table_name, ())):
+            yield defer.maybeDeferred(handler, model_class, operation, id)
@@ -0,0 +1,104 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+TEXT = "text"
+CSV = "csv"
+
+class CopyReader(object):
+    """
+    File-like object giving rows in the PostgreSQL COPY text or csv format.
+    Rows are pulled from the iterable only when the database asks for more
+    data, so memory stays flat whatever the number of rows.
+    """
+
+    def __init__(self, model_class, rows, columns, format=TEXT):
+        if format not in (TEXT, CSV):
+            raise Exception("ERROR: COPY format {0} not supported".format(format))
+
+        self.rows = iter(rows)
+        self.fields = [model_class._meta.fields[name] for name in columns]
+        self.format = format
+
+        # Serialized data not read yet
+        self.buffer = ""
+
+        # Number of rows serialized
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+
+            self.buffer += self.format_row(row)
+            self.count += 1
+
+        if size < 0:
+            data, self.buffer = self.buffer, ""
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def format_row(self, row):
+        if hasattr(row, "_meta"):
+            row = row.dictValues
+
+        values = []
+        for field in self.fields:
+            value = row.get(field.name)
+
+            # Related model given instead of its key
+            if hasattr(value, "_meta"):
+                value = getattr(value, field.reference.name)
+
+            if value is not None:
+                value = field.insert_format(value)
+
+            values.append(self.format_value(value))
+
+        if self.format == CSV:
+            return ",".join(values) + "\n"
+        return "\t".join(values) + "\n"
+
+    def format_value(self, value):
+        if value is None:
+            return "" if self.format == CSV else "\\N"
+
+        if isinstance(value, bool):
+            value = "t" if value else "f"
+        elif isinstance(value, float):
+            value = repr(value)
+        elif isinstance(value, unicode):
+            value = value.encode("utf-8")
+        else:
+            value = str(value)
+
+        if self.format == CSV:
+            return '"{0}"'.format(value.replace('"', '""'))
+
+        return (value.replace("\\", "\\\\")
+                     .replace("\t", "\\t")
+                     .replace("\n", "\\n")
+                     .replace("\r", "\\r"))
@@ -0,0 +1,224 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections, time
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+class ConnectionPool(object):
+    """
+    Pool of database connections. Connections are opened on demand up to
+    max_size and handed out to callers in the order they asked for one.
+    It exposes the same run methods as a single txpostgres connection.
+    """
+
+    def __init__(self, factory, min_size=1, max_size=10,
+                 acquire_timeout=None, reactor=None):
+        if not reactor:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        # Callable returning a Deferred which fires with a new connection
+        self.factory = factory
+
+        # Number of connections opened when the pool starts
+        self.min_size = min_size
+
+        # Maximum number of connections opened at the same time
+        self.max_size = max(max_size, min_size)
+
+        # Seconds to wait for a connection before failing. None waits forever
+        self.acquire_timeout = acquire_timeout
+
+        # All connections owned by the pool
+        self.connections = []
+
+        # Connections not used by anyone
+        self.idle = collections.deque()
+
+        # Callers waiting for a connection: (deferred, start time, timeout call)
+        self.waiters = collections.deque()
+
+        # Number of connections being opened
+        self.opening = 0
+
+        self.closed = False
+
+        # Statistics
+        self.acquired = 0
+        self.timeouts = 0
+        self.acquire_time = 0.0
+        self.max_acquire_time = 0.0
+
+    @inlineCallbacks
+    def start(self):
+        """
+        Open the minimum number of connections
+        """
+        yield defer.gatherResults([self._open() for _ in range(self.min_size)])
+
+    @inlineCallbacks
+    def _open(self):
+        self.opening += 1
+        try:
+            connection = yield self.factory()
+        finally:
+            self.opening -= 1
+
+        # Connection was down and is back. Give it to whoever is waiting
+        if connection.detector:
+            connection.detector.addRecoveryHandler(self._dispatch)
+
+        self.connections.append(connection)
+        self.idle.append(connection)
+        self._dispatch()
+
+    def is_healthy(self, connection):
+        """
+        A connection is healthy unless its detector is reconnecting it
+        """
+        return not (connection.detector and connection.detector.connectionIsDead)
+
+    def acquire(self):
+        """
+        Get a connection from the pool. Returns a Deferred firing with the
+        connection. It must be given back using release.
+        """
+        if self.closed:
+            return defer.fail(Exception("ERROR: Connection pool is closed"))
+
+        d = defer.Deferred()
+        call = None
+        if self.acquire_timeout is not None:
+            call = self.reactor.callLater(self.acquire_timeout, self._timeout, d)
+
+        self.waiters.append((d, time.time(), call))
+        self._dispatch()
+        return d
+
+    def release(self, connection):
+        """
+        Give a connection back to the pool
+        """
+        if self.closed or connection not in self.connections:
+            return
+
+        self.idle.append(connection)
+        self._dispatch()
+
+    def _dispatch(self):
+        """
+        Hand out healthy idle connections to waiters. Open a new connection if
+        callers are still waiting and the pool is not full.
+        """
+        unhealthy = []
+        while self.waiters and self.idle:
+            connection = self.idle.popleft()
+            if not self.is_healthy(connection):
+                unhealthy.append(connection)
+                continue
+
+            d, start, call = self.waiters.popleft()
+            if call and call.active():
+                call.cancel()
+
+            elapsed = time.time() - start
+            self.acquired += 1
+            self.acquire_time += elapsed
+            self.max_acquire_time = max(self.max_acquire_time, elapsed)
+            d.callback(connection)
+
+        self.idle.extend(unhealthy)
+
+        missing = len(self.waiters) - self.opening
+        while (missing > 0 and not self.closed and
+               len(self.connections) + self.opening < self.max_size):
+            d = self._open()
+            d.addErrback(self._openError)
+            missing -= 1
+
+    def _openError(self, f):
+        print("ERROR: opening pool connection failed with {0}".format(f.value))
+
+    def _timeout(self, d):
+        for waiter in self.waiters:
+            if waiter[0] is d:
+                self.waiters.remove(waiter)
+                break
+
+        self.timeouts += 1
+        d.errback(defer.TimeoutError("ERROR: No connection available after {0}s"
+                                     .format(self.acquire_timeout)))
+
+    @inlineCallbacks
+    def _run(self, method, *args, **kwargs):
+        connection = yield self.acquire()
+        try:
+            result = yield getattr(connection, method)(*args, **kwargs)
+        finally:
+            self.release(connection)
+        returnValue(result)
+
+    def runQuery(self, *args, **kwargs):
+        return self._run("runQuery", *args, **kwargs)
+
+    def runOperation(self, *args, **kwargs):
+        return self._run("runOperation", *args, **kwargs)
+
+    def runInteraction(self, *args, **kwargs):
+        return self._run("runInteraction", *args, **kwargs)
+
+    def close(self):
+        """
+        Close every connection and fail callers still waiting
+        """
+        self.closed = True
+
+        while self.waiters:
+            d, start, call = self.waiters.popleft()
+            if call and call.active():
+                call.cancel()
+            d.errback(Exception("ERROR: Connection pool closed"))
+
+        for connection in self.connections:
+            connection.close()
+
+        self.connections = []
+        self.idle.clear()
+
+    def stats(self):
+        """
+        Current state of the pool and acquire latency (in seconds)
+        """
+        return {
+            "size": len(self.connections),
+            "in_use": len(self.connections) - len(self.idle),
+            "idle": len(self.idle),
+            "waiters": len(self.waiters),
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "acquire_latency_avg": (self.acquire_time / self.acquired
+                                    if self.acquired else 0.0),
+            "acquire_latency_max": self.max_acquire_time
+        }
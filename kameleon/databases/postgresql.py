@@ -22,10 +22,22 @@
 # SOFTWARE.
 ################################################################################
 
+import itertools, random, re
+
+from twisted.internet import defer, task, threads
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+import psycopg2cffi
 from psycopg2cffi import IntegrityError
+from psycopg2cffi.extensions import TransactionRollbackError
 from base import Database
+from pool import ConnectionPool
+from cache import LRUCache, ResultCache, freeze
+from feed import ChangeFeed, CHANNEL_PREFIX
+from transaction import Transaction
+from pgcopy import CopyReader
+
+PLACEHOLDER = re.compile(r"%(%|s)")
 
 class PostgresqlDatabase(Database):
 
@@ -42,11 +54,95 @@ class PostgresqlDatabase(Database):
         'DATE': 'date'
     }
 
+    # Statements which can be prepared
+    PREPARABLE = ("SELECT", "INSERT", "UPDATE", "DELETE")
+
+    # Errors after which a transaction is retried: serialization failure
+    # and deadlock
+    RETRYABLE = ("40001", "40P01")
+
+    # Error of a statement naming a prepared statement that does not exist
+    INVALID_STATEMENT = "26000"
+
+    def __init__(self, name, min_connections=1, max_connections=None,
+                 acquire_timeout=None, prepare_threshold=None,
+                 prepared_cache_size=100, sql_cache_size=256,
+                 result_cache_size=1024, listen=False, transaction_retries=3,
+                 retry_backoff=0.05, **connect_kwargs):
+        super(PostgresqlDatabase, self).__init__(name, **connect_kwargs)
+
+        # Changes of models are propagated to their live instances
+        self.subscribe = True
+
+        # Maximum number of connections. If not set, a single connection is
+        # shared by every query
+        self.max_connections = max_connections
+
+        # Number of connections opened when connecting in pooled mode
+        self.min_connections = min_connections
+
+        # Seconds to wait for a free connection in pooled mode
+        self.acquire_timeout = acquire_timeout
+
+        # Number of executions of a statement before it is prepared on the
+        # connection running it. None never prepares statements
+        self.prepare_threshold = prepare_threshold
+
+        # Maximum number of prepared statements kept by each connection
+        self.prepared_cache_size = prepared_cache_size
+
+        # Number of executions of each statement
+        self._executions = LRUCache(prepared_cache_size * 10)
+
+        # Unique names of prepared statements
+        self._statement_ids = itertools.count()
+
+        # Maximum number of query shapes kept by the SQL cache of each model
+        self.sql_cache_size = sql_cache_size
+
+        # Generated SQL of each model, by query shape
+        self.sql_caches = {}
+
+        # Rows of the queries of cached models, by SQL and params
+        self.result_cache = ResultCache(result_cache_size)
+
+        # Open a connection listening to the changes made by other processes
+        # to the tables of propagated and cached models
+        self.listen = listen
+        self.feed = ChangeFeed(self)
+
+        # Backend process of each open connection. Notifications sent by
+        # them come from this process
+        self.backend_pids = set()
+
+        # Number of times a transaction is retried after a serialization
+        # failure or a deadlock, and seconds to wait before the first retry.
+        # The wait doubles with each retry
+        self.transaction_retries = transaction_retries
+        self.retry_backoff = retry_backoff
+
     def connectionError(self, f):
         print("ERROR: connecting failed with {0}".format(f.value))
 
     @inlineCallbacks
     def _connect(self, **kwargs):
+        if self.max_connections:
+            self.connection = ConnectionPool(lambda: self._open_connection(**kwargs),
+                                             min_size=self.min_connections,
+                                             max_size=self.max_connections,
+                                             acquire_timeout=self.acquire_timeout)
+            yield self.connection.start()
+        else:
+            self.connection = yield self._open_connection(**kwargs)
+
+        if self.listen:
+            listener = yield self._open_connection(**kwargs)
+            yield self.feed.start(listener)
+
+        print("INFO: Database connected -- %s" %self.name)
+
+    @inlineCallbacks
+    def _open_connection(self, **kwargs):
         from txpostgres import txpostgres, reconnection
         from txpostgres.reconnection import DeadConnectionDetector
 
@@ -63,33 +159,151 @@ class PostgresqlDatabase(Database):
 
             def connectionRecovered(self):
                 print("INFO: connection recovered")
+                # Prepared statements were lost with the old session
+                self.reconnectable.prepared.clear()
                 return DeadConnectionDetector.connectionRecovered(self)
 
-        self.connection = txpostgres.Connection(detector=LoggingDetector())
-        d = self.connection.connect(host=kwargs['host'],
-                                    database=self.name,
-                                    user=kwargs['user'],
-                                    password=kwargs['password'])
-        d.addErrback(self.connection.detector.checkForDeadConnection)
+        def deathChecker(f):
+            # Serialization failures and deadlocks leave the connection usable,
+            # the transaction is retried. So does a missing prepared statement
+            return (reconnection.defaultDeathChecker(f) and
+                    not f.check(TransactionRollbackError) and
+                    getattr(f.value, "pgcode", None) != self.INVALID_STATEMENT)
+
+        connection = txpostgres.Connection(detector=LoggingDetector(deathChecker=deathChecker))
+
+        # Statements prepared on this connection and their name
+        connection.prepared = LRUCache(self.prepared_cache_size)
+
+        d = connection.connect(host=kwargs['host'],
+                               database=self.name,
+                               user=kwargs['user'],
+                               password=kwargs['password'])
+        d.addErrback(connection.detector.checkForDeadConnection)
         d.addErrback(self.connectionError)
         yield d
-        print("INFO: Database connected -- %s" %self.name)
+
+        # The backend changes when the connection is recovered
+        connection.pid = None
+        self._track_backend(connection)
+        connection.detector.addRecoveryHandler(lambda: self._track_backend(connection))
+
+        returnValue(connection)
+
+    def _track_backend(self, connection):
+        self.backend_pids.discard(connection.pid)
+        try:
+            connection.pid = connection._connection.get_backend_pid()
+        except Exception:
+            connection.pid = None
+        else:
+            self.backend_pids.add(connection.pid)
+
+    def pool_stats(self):
+        if isinstance(getattr(self, "connection", None), ConnectionPool):
+            return self.connection.stats()
+        return None
+
+    def sql_cache_stats(self, model_class):
+        if model_class not in self.sql_caches:
+            return None
+        return self.sql_caches[model_class].stats()
+
+    def result_cache_stats(self):
+        return self.result_cache.stats()
 
     @inlineCallbacks
     def _close(self, *args):
         try:
+            yield self.feed.stop()
             if self.connection:
                 yield self.connection.close()
+            self.backend_pids.clear()
         except Exception as err:
             print("ERROR: while closing DB connection")
             print(err)
         else:
             print("INFO: Connection close cleanly")
 
+    @inlineCallbacks
+    def _execute(self, method, query, params=None):
+        """
+        Run a statement. Once a statement ran prepare_threshold times it is
+        prepared on the connection and run with EXECUTE
+        """
+        if not self.prepare_threshold or not query.lstrip().upper().startswith(self.PREPARABLE):
+            result = yield getattr(self.connection, method)(query, params)
+            returnValue(result)
+
+        if isinstance(self.connection, ConnectionPool):
+            connection = yield self.connection.acquire()
+            try:
+                result = yield self._execute_prepared(connection, method, query, params)
+            finally:
+                self.connection.release(connection)
+        else:
+            result = yield self._execute_prepared(self.connection, method, query, params)
+
+        returnValue(result)
+
+    @inlineCallbacks
+    def _execute_prepared(self, connection, method, query, params):
+        name = connection.prepared.get(query)
+        if name is None:
+            count = self._executions.get(query, 0)
+            # Statement failed to prepare before
+            if count is None or count + 1 < self.prepare_threshold:
+                if count is not None:
+                    self._executions.set(query, count + 1)
+                result = yield getattr(connection, method)(query, params)
+                returnValue(result)
+
+            # Registered before preparing so concurrent calls queue behind it
+            name = "kameleon_{0}".format(next(self._statement_ids))
+            for _, evicted in connection.prepared.set(query, name):
+                d = connection.runOperation("DEALLOCATE {0}".format(evicted))
+                d.addErrback(self._deallocateError, evicted)
+
+            try:
+                yield connection.runOperation("PREPARE {0} AS {1}"
+                                              .format(name, self._positional(query)))
+            except Exception as err:
+                print("WARNING: Cannot prepare {0}: {1}".format(query, err))
+                # The cache is cleared if the connection was recovered
+                connection.prepared.pop(query, None)
+                self._executions.set(query, None)
+                result = yield getattr(connection, method)(query, params)
+                returnValue(result)
+
+        if params:
+            statement = "EXECUTE {0}({1})".format(name, ",".join(["%s" for x in params]))
+        else:
+            statement = "EXECUTE {0}".format(name)
+
+        result = yield getattr(connection, method)(statement, params)
+        returnValue(result)
+
+    def _deallocateError(self, f, name):
+        # Statements are lost with the session if the connection was recovered
+        print("WARNING: Cannot deallocate {0}: {1}".format(name, f.value))
+
+    def _positional(self, query):
+        """
+        Replace %s placeholders with $1, $2... as used by PREPARE
+        """
+        position = itertools.count(1)
+
+        def replace(match):
+            if match.group(1) == "%":
+                return "%"
+            return "${0}".format(next(position))
+
+        return PLACEHOLDER.sub(replace, query.rstrip().rstrip(";"))
+
     @inlineCallbacks
     def runOperation(self, *args):
         try:
-            yield self.connection.runOperation(*args)
+            yield self._execute("runOperation", *args)
         except IntegrityError as err:
             exc = Exception("Constraint Error")
             exc.pgcode = err.pgcode
@@ -102,13 +316,171 @@ class PostgresqlDatabase(Database):
     def runQuery(self, *args):
         answer = []
         try:
-            answer = yield self.connection.runQuery(*args)
+            answer = yield self._execute("runQuery", *args)
         except Exception as err:
             print("ERROR: Running query {0}".format(args[0]))
             print(err)
             # Return special values if error. The code should be able to know
         returnValue(answer)
 
+    @inlineCallbacks
+    def runCachedQuery(self, tables, ttl, query, params=None):
+        """
+        Run a query reading tables through the result cache. Its rows are
+        kept ttl seconds unless one of the tables is written before
+        """
+        try:
+            key = (query, freeze(params))
+            rows = self.result_cache.get(key)
+        except TypeError:
+            # Params which cannot be hashed are never cached
+            rows = yield self.runQuery(query, params)
+            returnValue(rows)
+
+        if rows is not None:
+            returnValue(rows)
+
+        generation = self.result_cache.generation(tables)
+        try:
+            rows = yield self._execute("runQuery", query, params)
+        except Exception as err:
+            # Same answer as runQuery, but errors are not cached
+            print("ERROR: Running query {0}".format(query))
+            print(err)
+            returnValue([])
+
+        self.result_cache.set(key, rows, tables, ttl, generation)
+        returnValue(rows)
+
+    def watch(self, model_class):
+        return self.feed.watch(model_class)
+
+    def observe(self, model):
+        self.feed.observe(model)
+
+    def propagate(self, model, fields=None):
+        """
+        Apply the saved fields of model to the other live instances of its
+        row. Other processes are notified by the trigger of the table
+        """
+        names = fields or model._meta.sorted_fields_names
+        values = {name : model._values[model._meta.fields[name].index] for name in names}
+        values["id"] = model.id
+        self.feed.publish(type(model), values, model)
+
+    def invalidate(self, model_class, cascade=False):
+        """
+        Drop the cached results reading the table of model_class. With cascade
+        the tables referencing it are dropped too, as ON DELETE CASCADE may
+        have removed their rows
+        """
+        models = [model_class]
+        seen = set()
+        while models:
+            model = models.pop()
+            if model in seen:
+                continue
+            seen.add(model)
+
+            self.result_cache.invalidate(model._meta.table_name)
+            if cascade:
+                models.extend(model._meta.reverse_rel.values())
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        return self.connection.runInteraction(interaction, *args, **kwargs)
+
+    @inlineCallbacks
+    def runStream(self, interaction, *args, **kwargs):
+        """
+        Run interaction on a connection of its own, so queries made while it
+        runs do not wait for it. Pooled mode takes one from the pool, else a
+        connection is opened for it and closed once done
+        """
+        if isinstance(self.connection, ConnectionPool):
+            result = yield self.connection.runInteraction(interaction, *args, **kwargs)
+            returnValue(result)
+
+        connection = yield self._open_connection(**self.connect_kwargs)
+        try:
+            result = yield connection.runInteraction(interaction, *args, **kwargs)
+        finally:
+            self.backend_pids.discard(connection.pid)
+            connection.close()
+
+        returnValue(result)
+
+    @inlineCallbacks
+    def transaction(self, func, *args, **kwargs):
+        """
+        Run func(transaction, *args, **kwargs) in a transaction and return its
+        result. Queries given the transaction, e.g `model.save(transaction)`,
+        run on one connection and are committed together. If it fails with a
+        serialization failure or a deadlock, it is rolled back then run again
+        after a backoff. Queries not given the transaction must not be waited
+        for in func, they may wait for its connection
+        """
+        from twisted.internet import reactor
+
+        for attempt in itertools.count():
+            transaction = Transaction(self)
+            try:
+                result = yield self.runInteraction(self._transaction, transaction,
+                                                   func, args, kwargs)
+            except Exception as err:
+                transaction.rollback()
+
+                pgcode = getattr(err, "pgcode", None)
+                if pgcode not in self.RETRYABLE or attempt >= self.transaction_retries:
+                    raise
+
+                delay = self.retry_backoff * 2**attempt * random.uniform(0.5, 1.5)
+                print("WARNING: Transaction failed with {0}, retrying in {1:.3f}s"
+                      .format(pgcode, delay))
+                yield task.deferLater(reactor, delay, lambda: None)
+            else:
+                transaction.commit()
+                returnValue(result)
+
+    def _transaction(self, cursor, transaction, func, args, kwargs):
+        transaction.cursor = cursor
+        return defer.maybeDeferred(func, transaction, *args, **kwargs)
+
+    def copy_from(self, model_class, rows, columns, format="text", chunk_size=65536):
+        """
+        Stream rows into the table with COPY ... FROM STDIN. Asynchronous
+        connections cannot run COPY, so it runs on its own blocking connection
+        in a thread. Returns a Deferred firing with the number of rows copied.
+        """
+        reader = CopyReader(model_class, rows, columns, format)
+        query = ("COPY {0} ({1}) FROM STDIN WITH (FORMAT {2})"
+                 .format(model_class._meta.table_name, ",".join(columns), format))
+
+        d = threads.deferToThread(self._copy, query, reader, chunk_size)
+        d.addBoth(self._invalidated, model_class)
+        return d
+
+    def _invalidated(self, result, model_class, cascade=False):
+        """
+        Callback invalidating the cached results of model_class once a write
+        is done, whatever its outcome
+        """
+        self.invalidate(model_class, cascade)
+        return result
+
+    def _copy(self, query, reader, chunk_size):
+        connection = psycopg2cffi.connect(host=self.connect_kwargs['host'],
+                                          database=self.name,
+                                          user=self.connect_kwargs['user'],
+                                          password=self.connect_kwargs['password'])
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert(query, reader, chunk_size)
+            connection.commit()
+        finally:
+            connection.close()
+
+        return reader.count
+
     def create_table_title(self, name):
         return "CREATE TABLE %s (" %(name)
 
@@ -121,6 +493,30 @@ class PostgresqlDatabase(Database):
     def create_unique(self, current, unique):
         return " %s UNIQUE (%s)," %(current, ",".join(unique))
 
+    def create_notify_trigger(self, table_name, per_row=True):
+        """
+        Trigger notifying each insert, update and delete on the table. Per
+        row, the id of each row is sent, else a single notification is sent
+        per statement
+        """
+        function = ("CREATE OR REPLACE FUNCTION kameleon_notify() RETURNS trigger AS $$ "
+                    "DECLARE row_id json; "
+                    "BEGIN "
+                    "IF TG_LEVEL = 'ROW' THEN "
+                    "IF TG_OP = 'DELETE' THEN row_id := to_json(OLD.id); "
+                    "ELSE row_id := to_json(NEW.id); END IF; "
+                    "END IF; "
+                    "PERFORM pg_notify('{0}' || TG_TABLE_NAME, "
+                    "json_build_object('op', TG_OP, 'id', row_id)::text); "
+                    "RETURN NULL; "
+                    "END; $$ LANGUAGE plpgsql;".format(CHANNEL_PREFIX))
+
+        trigger = ("CREATE TRIGGER kameleon_notify AFTER INSERT OR UPDATE OR DELETE "
+                   "ON {0} FOR EACH {1} EXECUTE PROCEDURE kameleon_notify();"
+                   .format(table_name, "ROW" if per_row else "STATEMENT"))
+
+        return function + " " + trigger
+
     def delete_table(self, table_name, cascade=True):
         operation = "DROP TABLE IF EXISTS %s"%(table_name)
         if cascade:
@@ -129,11 +525,33 @@ class PostgresqlDatabase(Database):
         operation +=";"
         return operation
 
-    def generate_insert(self, query):
+    def compiled(self, model_class, shape, generate, *args):
+        """
+        SQL of a query shape. It is generated on first use then taken from the
+        cache of the model, so repeated queries only bind their values
+        """
+        if model_class not in self.sql_caches:
+            self.sql_caches[model_class] = LRUCache(self.sql_cache_size)
+
+        str_query = self.sql_caches[model_class].get(shape)
+        if str_query is None:
+            str_query = generate(*args)
+            self.sql_caches[model_class].set(shape, str_query)
+        return str_query
 
-        keys = ",".join([x.encode("utf-8") for x in query.values.keys()])
-        inputs = ",".join([ "%s" for x in query.values.values()])
+    def generate_insert(self, query):
+        keys = query.values.keys()
         values = query.values.values()
+        if query.on_conflict:
+            values += values
+
+        shape = ("INSERT", tuple(keys), tuple(query.on_conflict), query.return_id)
+        str_query = self.compiled(query.model_class, shape, self._generate_insert, query, keys)
+        return str_query, values
+
+    def _generate_insert(self, query, keys):
+        inputs = ",".join([ "%s" for x in keys])
+        keys = ",".join([x.encode("utf-8") for x in keys])
 
         str_query = ("INSERT INTO {0} ({1}) VALUES ({2})"
                     .format(query.model_class._meta.table_name, keys, inputs))
@@ -141,7 +559,30 @@ class PostgresqlDatabase(Database):
         if query.on_conflict:
             str_query += (" ON CONFLICT ({0}) DO UPDATE SET ({1}) = ({2})"
                          .format(",".join(query.on_conflict), keys, inputs))
-            values += values
+
+        if query.return_id:
+            str_query += " RETURNING id"
+
+        str_query += ";"
+        return str_query
+
+    def generate_bulk_insert(self, query, rows):
+
+        keys = ",".join([x.encode("utf-8") for x in query.columns])
+        inputs = "({0})".format(",".join([ "%s" for x in query.columns]))
+        values = []
+        for row in rows:
+            values += [row.get(x) for x in query.columns]
+
+        str_query = ("INSERT INTO {0} ({1}) VALUES {2}"
+                    .format(query.model_class._meta.table_name, keys,
+                            ",".join([inputs]*len(rows))))
+
+        if query.on_conflict:
+            str_query += (" ON CONFLICT ({0}) DO UPDATE SET {1}"
+                         .format(",".join(query.on_conflict),
+                                 ",".join(["{0} = EXCLUDED.{0}".format(x.encode("utf-8"))
+                                           for x in query.columns])))
 
         if query.return_id:
             str_query += " RETURNING id"
@@ -151,74 +592,124 @@ class PostgresqlDatabase(Database):
 
     def generate_delete(self, query):
 
-        where=''
+        where = ''
+        params = []
         if query._where:
-            i = 0
-            if isinstance(query._where, str):
-                where = "WHERE {0}".format(query._where)
+            condition, params = self.parse_where(query._where)
+            where = "WHERE {0}".format(condition)
+
+        query = ('DELETE FROM {0} {1}{2};'
+                 .format(query.model_class._meta.table_name, where,
+                         self.generate_returning(query.model_class, query.returned_fields())))
+        return query, params
+
+    def generate_returning(self, model_class, names):
+        if not names:
+            return ""
+        return " RETURNING {0}".format(",".join(["{0}.{1}".format(model_class._meta.table_name, x)
+                                                 for x in names]))
+
+    def generate_set_update(self, queryInstance, values):
+        """
+        UPDATE of the rows matching a select. values are (field, value)
+        pairs, a value being either a value to bind or an expression, e.g
+        `Model.counter + 1`
+        """
+        table_name = queryInstance.model_class._meta.table_name
+
+        assignments = []
+        params = []
+        for field, value in values:
+            if hasattr(value, "parse"):
+                sql, value_params = value.parse()
             else:
-                for value in query._where:
-                    if i == 0:
-                        con = "WHERE "
-                    else:
-                        con = " AND "
-                    where += "%s %s.%s %s '%s'"%(con, value.lhs.model_class._meta.table_name, value.lhs.name, value.op, value.rhs)
-                    i+=1
-
-        query = 'DELETE FROM {0} {1};'.format(query.model_class._meta.table_name, where)
-        return query
+                sql, value_params = "%s", [value]
+            assignments.append("{0} = {1}".format(field.name.encode("utf-8"), sql))
+            params += value_params
 
-    def generate_update(self, query):
+        where, where_params = self.generate_where(queryInstance)
 
-        if query.model_class._meta.primary_key:
-            _id = query.values["id"]
-            del query.values["id"]
+        query = ("UPDATE {0} SET {1} {2}{3};"
+                 .format(table_name, ",".join(assignments), where,
+                         self.generate_returning(queryInstance.model_class,
+                                                 queryInstance.returned_fields())))
+        return query, params + where_params
 
-        keys = ",".join([x.encode("utf-8") for x in query.values.keys()])
-        inputs = ",".join([ "%s" for x in query.values.values()])
+    def generate_update(self, query):
 
-        if query.model_class._meta.primary_key:
-            str_query = ("UPDATE {0} SET ({1})=({2}) WHERE id = {3}"
-                        .format(query.model_class._meta.table_name, keys, inputs, _id))
-        else:
+        if not query.model_class._meta.primary_key:
             # XXX To Do: If not id -> check if one of the field is Unique. If one is unique use it to update
             print("ERROR: Not primary key cannot update row. Need to be implemented")
             raise Exception("ERROR: Not primary key cannot update row. Need to be implemented")
 
+        _id = query.values["id"]
+        del query.values["id"]
+
+        keys = query.values.keys()
+        values = query.values.values()
+        values.append(_id)
+
+        shape = ("UPDATE", tuple(keys), query.return_id)
+        str_query = self.compiled(query.model_class, shape, self._generate_update, query, keys)
+        return str_query, values
+
+    def _generate_update(self, query, keys):
+        # Single column updates cannot use the (a,b)=(x,y) form
+        keys = ",".join(["{0} = %s".format(x.encode("utf-8")) for x in keys])
+
+        str_query = ("UPDATE {0} SET {1} WHERE id = %s"
+                    .format(query.model_class._meta.table_name, keys))
+
         if query.return_id:
             str_query += " RETURNING id"
 
         str_query += ";"
-        return str_query, query.values.values()
+        return str_query
+
+    def generate_bulk_update(self, query, rows):
+        table_name = query.model_class._meta.table_name
+        names = [x.name.encode("utf-8") for x in query.fields]
+
+        # Values are not typed. Casting the first row gives the type of
+        # each column of the VALUES list
+        first = ",".join(["%s::{0}".format(x.get_db_field())
+                          for x in [query.model_class._meta.fields["id"]] + query.fields])
+        inputs = "({0})".format(",".join(["%s" for x in rows[0]]))
+        values = []
+        for row in rows:
+            values += row
+
+        str_query = ("UPDATE {0} SET {1} FROM (VALUES ({2}){3}) AS v (id,{4}) WHERE {0}.id = v.id RETURNING {0}.id;"
+                     .format(table_name,
+                             ",".join(["{0} = v.{0}".format(x) for x in names]),
+                             first,
+                             "".join([",{0}".format(inputs) for x in rows[1:]]),
+                             ",".join(names)))
+        return str_query, values
 
     def generate_add(self, query):
         table_name = query.model_class._meta.table_name
+        ids = [obj.id for obj in query.objs]
 
-        query = ("INSERT INTO {0} ({1}) SELECT {2} WHERE NOT EXISTS (SELECT {3} FROM {0} WHERE {3}='{5}' AND {4}='{6}');"
+        query = ("INSERT INTO {0} ({1}) SELECT %s,%s WHERE NOT EXISTS (SELECT {2} FROM {0} WHERE {2}=%s AND {3}=%s);"
                 .format(table_name,
                         ",".join(query.model_class._meta.sorted_fields_names),
-                        ",".join([str(obj.id) for obj in query.objs]),
                         query.model_class._meta.sorted_fields_names[0],
-                        query.model_class._meta.sorted_fields_names[1],
-                        query.objs[0].id,
-                        query.objs[1].id))
-        return query
+                        query.model_class._meta.sorted_fields_names[1]))
+        return query, ids + ids
 
     def generate_remove(self, query):
         table_name = query.model_class._meta.table_name
+        ids = [obj.id for obj in query.objs]
 
-        query = ("DELETE FROM {0} WHERE {1} = '{3}' AND {2}='{4}';"
+        query = ("DELETE FROM {0} WHERE {1}=%s AND {2}=%s;"
                 .format(table_name,
                         query.model_class._meta.sorted_fields_names[0],
-                        query.model_class._meta.sorted_fields_names[1],
-                        query.objs[0].id,
-                        query.objs[1].id))
-
-        return query
+                        query.model_class._meta.sorted_fields_names[1]))
 
-    def generate_select(self, queryInstance):
-        target = '*'
+        return query, ids
 
+    def generate_joins(self, queryInstance):
         joint = ""
         if queryInstance._joins:
             for join in queryInstance._joins:
@@ -243,126 +734,378 @@ class PostgresqlDatabase(Database):
 
                 joint += "%s %s on (%s = %s) "%(joint_type, join.dest._meta.table_name, clause1, clause2)
 
-        where=''
+        return joint
+
+    def parse_where(self, where):
+        """
+        SQL of a where clause, either raw SQL or an expression tree, and the
+        values to bind
+        """
+        if isinstance(where, str):
+            # Raw SQL. Its % must not be read as placeholders
+            return where.replace("%", "%%"), []
+        return where.parse()
+
+    def generate_where(self, queryInstance):
+        conditions = []
+        params = []
+        if queryInstance._where:
+            condition, params = self.parse_where(queryInstance._where)
+            conditions.append(condition)
+
+        # Keyset pagination. Compare the row of key fields with the last one seen
+        if queryInstance._keyset and queryInstance._after is not None:
+            op = "<" if queryInstance._keyset[0].direction == "DESC" else ">"
+            conditions.append("({0}) {1} ({2})"
+                              .format(",".join(["{0}.{1}".format(x.node.model_class._meta.table_name, x.node.name)
+                                                for x in queryInstance._keyset]),
+                                      op,
+                                      ",".join(["%s" for x in queryInstance._keyset])))
+            params = params + queryInstance._after
+
+        where = ''
+        if len(conditions) == 1:
+            where = "WHERE {0}".format(conditions[0])
+        elif conditions:
+            where = "WHERE {0}".format(" AND ".join(["({0})".format(x) for x in conditions]))
+
+        return where, params
+
+    def generate_modifiers(self, queryInstance):
+        """
+        Ordering and pagination of a select
+        """
+        modifiers = ""
+        params = []
+        if queryInstance._order_by:
+            orderings = []
+            for ordering in queryInstance._order_by:
+                sql, ordering_params = ordering.parse()
+                orderings.append(sql)
+                params += ordering_params
+            modifiers += " ORDER BY {0}".format(",".join(orderings))
+
+        # Bound so every page of a query has the same SQL
+        if queryInstance._limit is not None:
+            modifiers += " LIMIT %s"
+            params.append(queryInstance._limit)
+
+        if queryInstance._offset:
+            modifiers += " OFFSET %s"
+            params.append(queryInstance._offset)
+
+        return modifiers, params
+
+    def select_signature(self, queryInstance):
+        """
+        Shape of a select and the values it binds, in generate_select() order
+        """
+        where = None
+        params = []
         if queryInstance._where:
-            i = 0
             if isinstance(queryInstance._where, str):
-                where = "WHERE {0}".format(queryInstance._where)
+                where = queryInstance._where
             else:
-                where = queryInstance._where.parse()
-                where = "WHERE {0}".format(where)
+                where, params = queryInstance._where.signature()
+
+        keyset = None
+        if queryInstance._keyset and queryInstance._after is not None:
+            keyset = tuple([x.signature()[0] for x in queryInstance._keyset])
+            params = params + queryInstance._after
+
+        modifiers = None
+        if not queryInstance._delete:
+            orderings = []
+            for ordering in queryInstance._order_by:
+                ordering, ordering_params = ordering.signature()
+                orderings.append(ordering)
+                params = params + ordering_params
+
+            if queryInstance._limit is not None:
+                params.append(queryInstance._limit)
+            if queryInstance._offset:
+                params.append(queryInstance._offset)
+
+            modifiers = (tuple(orderings), queryInstance._limit is not None,
+                         bool(queryInstance._offset))
+
+        shape = ("DELETE" if queryInstance._delete else "SELECT",
+                 tuple(queryInstance.returned_fields()),
+                 tuple([(x.src, x.dest, x.joint_type) for x in queryInstance._joins]),
+                 tuple([x.signature()[0] for x in queryInstance._only]),
+                 tuple([x.signature()[0] for x in queryInstance._defer]),
+                 tuple([x.node.name for x in queryInstance._keyset]),
+                 where, keyset, modifiers)
+        return shape, params
+
+    def generate_select(self, queryInstance):
+        shape, params = self.select_signature(queryInstance)
+        query = self.compiled(queryInstance.model_class, shape,
+                              self._generate_select, queryInstance)
+        return query, params
+
+    def _generate_select(self, queryInstance):
+        target = '*'
+        if queryInstance._only or queryInstance._defer:
+            models = [queryInstance.model_class] + [x.dest for x in queryInstance._joins]
+            target = ",".join(["{0}.{1}".format(model._meta.table_name, name)
+                               for model in models
+                               for name in queryInstance.selected_fields(model)])
+
+        # Values are bound from select_signature()
+        joint = self.generate_joins(queryInstance)
+        where = self.generate_where(queryInstance)[0]
+
+        # Ordering and pagination. Not available on delete
+        modifiers = ""
+        if not queryInstance._delete:
+            modifiers = self.generate_modifiers(queryInstance)[0]
 
         end = ";"
         if queryInstance._delete:
             queryType = "DELETE"
-            if queryInstance.model_class._meta.primary_key:
-                end = " RETURNING id;"
+            end = "{0};".format(self.generate_returning(queryInstance.model_class,
+                                                        queryInstance.returned_fields()))
         else:
-            queryType = "SELECT {0}".format(",".join(target))
+            queryType = "SELECT {0}".format(target)
 
-        query = ('{0} FROM {1} {2} {3}{4}'
+        query = ('{0} FROM {1} {2} {3}{4}{5}'
                 .format(queryType, queryInstance.model_class._meta.table_name,
-                        joint, where, end))
+                        joint, where, modifiers, end))
         # print(query)
         return query
 
+    def generate_count(self, queryInstance):
+        table_name = queryInstance.model_class._meta.table_name
+        joint = self.generate_joins(queryInstance)
+        where, params = self.generate_where(queryInstance)
+
+        # Joins repeat rows of the model. Count each row once
+        target = "COUNT(*)"
+        if joint and queryInstance.model_class._meta.primary_key:
+            target = "COUNT(DISTINCT {0}.id)".format(table_name)
+
+        if queryInstance._limit is not None or queryInstance._offset:
+            modifiers, modifiers_params = self.generate_modifiers(queryInstance)
+            query = ("SELECT COUNT(*) FROM (SELECT {0}.* FROM {0} {1} {2}{3}) AS _count;"
+                     .format(table_name, joint, where, modifiers))
+            params = params + modifiers_params
+        else:
+            query = ("SELECT {0} FROM {1} {2} {3};"
+                     .format(target, table_name, joint, where))
+
+        return query, params
+
+    def generate_approximate_count(self, queryInstance):
+        """
+        Row count estimated by the planner statistics of the table
+        """
+        query = "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass;"
+        return query, [queryInstance.model_class._meta.table_name]
+
+    def generate_exists(self, queryInstance):
+        joint = self.generate_joins(queryInstance)
+        where, params = self.generate_where(queryInstance)
+
+        query = ("SELECT EXISTS (SELECT 1 FROM {0} {1} {2} LIMIT 1);"
+                 .format(queryInstance.model_class._meta.table_name, joint, where))
+        return query, params
+
+    def generate_aggregate(self, queryInstance, aggregates):
+        group_by = ["{0}.{1}".format(x.model_class._meta.table_name, x.name)
+                    for x in queryInstance._group_by]
+
+        target = list(group_by)
+        params = []
+        for aggregate in aggregates:
+            sql, aggregate_params = aggregate.parse()
+            target.append(sql)
+            params += aggregate_params
+        target = ",".join(target)
+
+        joint = self.generate_joins(queryInstance)
+        where, where_params = self.generate_where(queryInstance)
+        params += where_params
+
+        modifiers = ""
+        if group_by:
+            modifiers += " GROUP BY {0}".format(",".join(group_by))
+        order, order_params = self.generate_modifiers(queryInstance)
+        modifiers += order
+        params += order_params
+
+        query = ("SELECT {0} FROM {1} {2} {3}{4};"
+                 .format(target, queryInstance.model_class._meta.table_name,
+                         joint, where, modifiers))
+        return query, params
+
     def parse_select(self, query, result):
         class_list = []
 
-        if query._joins:
-            current = [None]*len(query._joins) + [None]
-            models_class = {}
-            rel = []
-            pos = {}
-
+        # Columns selected for each model. Rows are sliced using their width
+        columns = {query.model_class: query.selected_fields(query.model_class)}
+        for join in query._joins:
+            columns[join.dest] = query.selected_fields(join.dest)
+
+        # Rows changed by an update or a delete only hold the returned columns
+        if query._delete or query._update is not None:
+            columns = {query.model_class: query.returned_fields()}
+
+        # Rows straight from the driver
+        if query._result_mode == "tuples":
+            return list(result)
+
+        if query._result_mode == "dicts":
+            names = list(columns[query.model_class])
+            for join in query._joins:
+                names += ["{0}.{1}".format(join.dest._meta.table_name, x) for x in columns[join.dest]]
+            return [dict(zip(names, res)) for res in result]
+
+        if query._result_mode == "scalars":
+            index = 0
+            for model_class in [query.model_class] + [x.dest for x in query._joins]:
+                if model_class == query._scalar.model_class:
+                    index += columns[model_class].index(query._scalar.name)
+                    break
+                index += len(columns[model_class])
+            return [res[index] for res in result]
+
+        # Fields not selected, to load later
+        deferred = dict([(x, set(x._meta.sorted_fields_names) - set(columns[x])) for x in columns])
+
+        # Rows already held by the session of the query are its instances.
+        # Reference lists they hold which this query fills are emptied the
+        # first time they are met, not to hold rows twice
+        session = query._session if not (query._delete or query._update is not None) else None
+        met = set()
+        filled = dict([(x, []) for x in columns])
+
+        def build(model_class, values):
+            model = model_class.from_row(values, columns[model_class])
+            if deferred[model_class]:
+                model._deferred = set(deferred[model_class])
+            if session is None:
+                return model
+
+            known = session.merge(model)
+            if known is not model and id(known) not in met and known._related:
+                for name in filled[model_class]:
+                    known._related.pop(name, None)
+            met.add(id(known))
+            return known
+
+        if not query._joins:
             for res in result:
-                start = len(query.model_class._meta.sorted_fields_names)
-                curr_list = res[:start]
-                i = 0
-
-                if not models_class:
-                    pos[query.model_class] = i
-                    rel.append(None)
-
-                if not str(curr_list) in models_class:
-                    kwargs = dict(zip(query.model_class._meta.sorted_fields_names, curr_list))
-                    last_model = query.model_class(**kwargs)
-                    models_class[str(curr_list)] = {
-                        "model": last_model
-                    }
-                    class_list.append(last_model)
-
-                current[i] = models_class[str(curr_list)]
-
-                for join in query._joins:
-                    curr_list = res[start:start+len(join.dest._meta.sorted_fields_names)]
-
-                    start += len(join.dest._meta.sorted_fields_names)
-                    i += 1
-
-                    if len(rel) == i:
-                        pos[join.dest] = i
-                        rel.append(pos[join.src])
-
-                    if curr_list == [None]*len(join.dest._meta.sorted_fields_names):
-                        current[i] = {
-                            "model" : None
-                        }
-                        if not i in current[rel[i]]:
-                            current[rel[i]][i] = {}
-
-                        current[rel[i]][i]["None"] = current[i]
-                        continue
-                    else:
-                        if not i in current[rel[i]] or not str(curr_list) in current[rel[i]][i]:
-                            kwargs = dict(zip(join.dest._meta.sorted_fields_names, curr_list))
-                            new_model = join.dest(**kwargs)
-                            current[i] = {
-                                "model" : new_model
-                            }
-
-                            if not i in current[rel[i]]:
-                                current[rel[i]][i] = {}
-
-                            current[rel[i]][i][str(curr_list)] = current[i]
-                        else:
-                            current[i] = current[rel[i]][i][str(curr_list)]
-                            continue
-
-                        current[i] = current[rel[i]][i][str(curr_list)]
-                        new_model = current[i]["model"]
-
-                        if join.src in pos:
-                            if join.src._meta.many_to_many:
-                                middle_table_index = rel[i]
-                                index = pos[current[rel[i]]["model"].__class__]
-                                x = getattr(new_model, current[rel[i]]["model"]._meta.rel_class[join.dest].related_name)
-                                x.append(current[rel[index]]["model"])
-                                x = getattr(current[rel[index]]["model"], current[rel[i]]["model"]._meta.rel_class[join.dest].name)
-                                x.append(new_model)
-
-                            elif not join.dest._meta.many_to_many:
-                                if current[rel[i]]["model"].isForeignKey(current[rel[i]]["model"]._meta.rel_class[join.dest]):
-                                    x = getattr(new_model, current[rel[i]]["model"]._meta.rel_class[join.dest].related_name)
-                                    x.append(current[rel[i]]["model"])
-                                    setattr(current[rel[i]]["model"], current[rel[i]]["model"]._meta.rel_class[join.dest].name, new_model)
-
-                                elif current[rel[i]]["model"].isReferenceField(current[rel[i]]["model"]._meta.rel_class[join.dest]):
-                                    x = getattr(current[rel[i]]["model"], current[rel[i]]["model"]._meta.rel_class[join.dest].name)
-                                    x.append(new_model)
-                                    setattr(new_model, current[rel[i]]["model"]._meta.rel_class[join.dest].related_name, current[rel[i]]["model"])
-                                else:
-                                    raise Exception("Here Logic error")
-
-                        else:
-                            raise Exception("Logic error")
+                class_list.append(build(query.model_class, res))
+            return class_list
+
+        # Models in the order of their columns. Position of the columns, of
+        # the primary key and of the model joined from for each of them
+        models = [query.model_class] + [x.dest for x in query._joins]
+        slices = []
+        keys = []
+        start = 0
+        for model_class in models:
+            slices.append((start, start + len(columns[model_class])))
+            start += len(columns[model_class])
+
+            if model_class._meta.primary_key and "id" in columns[model_class]:
+                keys.append(columns[model_class].index("id"))
+            else:
+                keys.append(None)
+
+        pos = {query.model_class: 0}
+        rel = [None]
+        links = [None]
+        for i, join in enumerate(query._joins, 1):
+            if not join.src in pos:
+                raise Exception("Logic error")
+            pos[join.dest] = i
+            rel.append(pos[join.src])
+
+            # How a new model is attached to the model it was joined from
+            field = join.src._meta.rel_class.get(join.dest)
+            if join.src._meta.many_to_many:
+                links.append(("many_to_many", field))
+                filled[join.dest].append(field.related_name)
+                filled[models[rel[pos[join.src]]]].append(field.name)
+            elif join.dest._meta.many_to_many:
+                links.append((None, field))
+            elif join.src.isForeignKey(field):
+                links.append(("foreign_key", field))
+                filled[join.dest].append(field.related_name)
+            elif join.src.isReferenceField(field):
+                links.append(("reference", field))
+                filled[join.src].append(field.name)
+            else:
+                links.append(("error", field))
+
+        def identity(i, values):
+            """
+            Key of a row slice. Its primary key, else the values themselves
+            """
+            if keys[i] is not None:
+                return values[keys[i]]
+            try:
+                hash(values)
+                return values
+            except TypeError:
+                return str(values)
+
+        # A node is a model and its children, keyed by join position and
+        # identity. A joined row is only the same model under the same parent
+        roots = {}
+        current = [None]*len(models)
+
+        for res in result:
+            values = res[:slices[0][1]]
+            key = identity(0, values)
+            node = roots.get(key)
+            if node is None:
+                node = roots[key] = (build(query.model_class, values), {})
+                class_list.append(node[0])
+            current[0] = node
+
+            for i in range(1, len(models)):
+                values = res[slices[i][0]:slices[i][1]]
+                parent = current[rel[i]]
+
+                # Nothing joined (LEFT JOIN)
+                if keys[i] is not None:
+                    missing = values[keys[i]] is None
+                else:
+                    missing = values.count(None) == len(values)
 
-        else:
-            for res in result:
-                kwargs = dict(zip(query.model_class._meta.sorted_fields_names, res))
-                class_list.append(query.model_class(**kwargs))
+                if missing:
+                    current[i] = (None, {})
+                    continue
+
+                key = (i, identity(i, values))
+                node = parent[1].get(key)
+                if node is not None:
+                    current[i] = node
+                    continue
+
+                new_model = build(models[i], values)
+                node = current[i] = parent[1][key] = (new_model, {})
+
+                link, field = links[i]
+                if link == "many_to_many":
+                    # Link both ends of the middle table
+                    other = current[rel[rel[i]]][0]
+                    getattr(new_model, field.related_name).append(other)
+                    getattr(other, field.name).append(new_model)
+
+                elif link == "foreign_key":
+                    getattr(new_model, field.related_name).append(parent[0])
+                    setattr(parent[0], field.name, new_model)
+
+                elif link == "reference":
+                    getattr(parent[0], field.name).append(new_model)
+                    setattr(new_model, field.related_name, parent[0])
+
+                elif link == "error":
+                    raise Exception("Here Logic error")
 
         return class_list
 
-    def propagate(self, model):
-        print("WARNING: Ignoring propagate -- Function not set")
@@ -33,3 +33,17 @@ class TimescaleDatabase(PostgresqlDatabase):
         _operation = ("SELECT create_hypertable('{0}', {1});"
                       .format(_meta.table_name, hypertable))
         return "{0} {1}".format(current, _operation)
+
+    def generate_approximate_count(self, queryInstance):
+        """
+        Rows of a hypertable are stored in its chunks. Sum their statistics
+        """
+        if not queryInstance.model_class._meta.hypertable:
+            return super(TimescaleDatabase, self).generate_approximate_count(queryInstance)
+
+        query = ("SELECT ((SELECT GREATEST(reltuples, 0) FROM pg_class WHERE oid = %s::regclass)"
+                 " + COALESCE(SUM(GREATEST(c.reltuples, 0)), 0))::bigint"
+                 " FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid"
+                 " WHERE i.inhparent = %s::regclass;")
+        table_name = queryInstance.model_class._meta.table_name
+        return query, [table_name, table_name]
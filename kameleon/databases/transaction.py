@@ -0,0 +1,163 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import itertools
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import failure
+
+from psycopg2cffi import IntegrityError
+
+class Transaction(object):
+    """
+    Database used by the queries run in a transaction, see
+    Database.transaction. Statements run one at a time on the cursor of the
+    transaction and are committed together. Cache invalidations and
+    propagations wait for the commit. Anything else is taken from the
+    database.
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+        # Cursor of the interaction running the transaction
+        self.cursor = None
+
+        # Statements cannot run concurrently on a cursor
+        self.lock = defer.DeferredLock()
+
+        # Calls made once committed
+        self.committed = []
+
+        # State of the instances written, restored if rolled back
+        self.tracked = {}
+
+        # Unique names of savepoints
+        self._savepoint_ids = itertools.count()
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def _run(self, query, params, fetch):
+        d = self.cursor.execute(query, params)
+        if fetch:
+            d.addCallback(lambda cursor: cursor.fetchall())
+        return d
+
+    @inlineCallbacks
+    def runQuery(self, query, params=None):
+        """
+        Errors are raised, the transaction is aborted anyway
+        """
+        try:
+            result = yield self.lock.run(self._run, query, params, True)
+        except IntegrityError as err:
+            exc = Exception("Constraint Error")
+            exc.pgcode = err.pgcode
+            raise exc
+        returnValue(result)
+
+    @inlineCallbacks
+    def runOperation(self, query, params=None):
+        try:
+            yield self.lock.run(self._run, query, params, False)
+        except IntegrityError as err:
+            exc = Exception("Constraint Error")
+            exc.pgcode = err.pgcode
+            raise exc
+
+    def runCachedQuery(self, tables, ttl, query, params=None):
+        # Rows may hold writes not committed yet
+        return self.runQuery(query, params)
+
+    def runInteraction(self, interaction, *args, **kwargs):
+        return self.lock.run(interaction, self.cursor, *args, **kwargs)
+
+    def invalidate(self, model_class, cascade=False):
+        self.committed.append(lambda: self.database.invalidate(model_class, cascade))
+
+    def propagate(self, model, fields=None):
+        self.committed.append(lambda: self.database.propagate(model, fields))
+
+    def track(self, model):
+        """
+        Remember the state of model before it is written, to restore it if
+        the transaction is rolled back
+        """
+        if id(model) not in self.tracked:
+            related = None
+            if model._related:
+                related = dict([(k, list(v) if isinstance(v, list) else v)
+                                for k, v in model._related.items()])
+            self.tracked[id(model)] = (model, list(model._values),
+                                       set(model._dirty) if model._dirty else None,
+                                       set(model._deferred) if model._deferred else None,
+                                       related,
+                                       dict(model._snapshot) if model._snapshot else None)
+
+    @inlineCallbacks
+    def savepoint(self, func, *args, **kwargs):
+        """
+        Run func(transaction, *args, **kwargs) in a savepoint. If it fails,
+        its statements are rolled back and the error raised, the rest of the
+        transaction can go on
+        """
+        name = "kameleon_savepoint_{0}".format(next(self._savepoint_ids))
+        yield self.runOperation("SAVEPOINT {0};".format(name))
+
+        # Instances written and calls made in the savepoint
+        tracked, self.tracked = self.tracked, {}
+        committed = len(self.committed)
+        try:
+            result = yield defer.maybeDeferred(func, self, *args, **kwargs)
+        except Exception:
+            # Kept before yielding, the current exception would be lost
+            error = failure.Failure()
+            yield self.runOperation("ROLLBACK TO SAVEPOINT {0};".format(name))
+            self.rollback()
+            del self.committed[committed:]
+            error.raiseException()
+        finally:
+            for key, state in self.tracked.items():
+                tracked.setdefault(key, state)
+            self.tracked = tracked
+
+        yield self.runOperation("RELEASE SAVEPOINT {0};".format(name))
+        returnValue(result)
+
+    def transaction(self, func, *args, **kwargs):
+        # Nested transactions are savepoints
+        return self.savepoint(func, *args, **kwargs)
+
+    def commit(self):
+        for call in self.committed:
+            call()
+
+    def rollback(self):
+        for model, values, dirty, deferred, related, snapshot in self.tracked.values():
+            model._values = values
+            model._dirty = dirty
+            model._deferred = deferred
+            model._related = related
+            model._snapshot = snapshot
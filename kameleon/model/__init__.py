@@ -25,5 +25,8 @@
 import fields
 
 from base import Model, BaseModel
+from session import Session
+from fields import Count, Sum, Avg, Min, Max
 
-__all__ = ["fields", "Model", "BaseModel"]
+__all__ = ["fields", "Model", "BaseModel", "Session", "Count", "Sum", "Avg",
+           "Min", "Max"]
@@ -22,16 +22,19 @@
 # SOFTWARE.
 ################################################################################
 
-import fields, collections, bcrypt
+import fields, collections, hashing
 
+from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from fields import PrimaryKeyField
 from query import SelectQuery, \
                   InsertQuery, \
+                  BulkInsertQuery, \
                   AddQuery, \
                   RemoveQuery, \
                   UpdateQuery, \
+                  BulkUpdateQuery, \
                   DeleteQuery
 
 """
@@ -40,7 +43,7 @@ This set of variable is represented by the class ModelOptions
 """
 _METACLASS_ = '_metaclass_helper_'
 def with_metaclass(meta, base=object):
-    return meta(_METACLASS_, (base,), {})
+    return meta(_METACLASS_, (base,), {"__slots__": ()})
 
 class ModelOptions(object):
     """
@@ -56,7 +59,8 @@ class ModelOptions(object):
                 many_to_many = False,
                 order = [],
                 propagate = False,
-                hypertable = []):
+                hypertable = [],
+                cache = None):
 
         # Model class
         self.model_class = cls
@@ -95,6 +99,10 @@ class ModelOptions(object):
         # Should the table change to hyper table.
         self.hypertable = hypertable
 
+        # Seconds the results of the queries of this model are cached. None
+        # never caches them
+        self.cache = cache
+
         # Map of fields
         self.fields = {}
 
@@ -125,10 +133,46 @@ class ModelOptions(object):
                   .format(field.name, self.table_name))
             return
 
+        field.index = len(self.sorted_fields)
         self.fields[field.name] = field
         self.sorted_fields.append(field)
         self.sorted_fields_names.append(field.name)
 
+def make_from_row(cls):
+    """
+    Build the constructor of models loaded from the database. Their values
+    are already formatted, so they are stored directly without going
+    through __init__ and the fields
+    """
+    meta = cls._meta
+    names = meta.sorted_fields_names
+    positions = dict([(name, i) for i, name in enumerate(names)])
+
+    def from_row(row, columns=None):
+        """
+        Model from the values of a row, in the order of columns. Fields not
+        in columns are set to None
+        """
+        model = cls.__new__(cls)
+        if columns is None or columns is names:
+            model._values = list(row)
+        else:
+            values = [None]*len(names)
+            for name, value in zip(columns, row):
+                values[positions[name]] = value
+            model._values = values
+
+        model._related = None
+        model._deferred = None
+        model._dirty = None
+        model._snapshot = None
+
+        if meta.propagate and meta.database.subscribe:
+            model._subscribe()
+        return model
+
+    return from_row
+
 class BaseModel(type):
     """
     Metaclass for all models.
@@ -146,8 +190,14 @@ class BaseModel(type):
                 if not k.startswith('_'):
                     meta_options[k] = v
 
+        # Instances only hold the slots declared by Model. Values are read
+        # through the fields, which are descriptors. attrs itself is left
+        # untouched: its order gives the order of the columns
+        class_attrs = dict(attrs)
+        class_attrs.setdefault('__slots__', ())
+
         # Create Model class and its options
-        cls = super(BaseModel, cls).__new__(cls, name, bases, attrs)
+        cls = super(BaseModel, cls).__new__(cls, name, bases, class_attrs)
         cls._meta = ModelOptions(cls, **meta_options)
 
         # If many to many initialize the links between the two tables.
@@ -187,6 +237,13 @@ class BaseModel(type):
                     if not key.startswith('_'):
                         value.add_to_model(cls, key)
 
+        # Constructor used to load rows
+        cls.from_row = staticmethod(make_from_row(cls))
+
+        # Changes made by other processes refresh the instances and caches
+        if cls._meta.database and (cls._meta.propagate or cls._meta.cache):
+            cls._meta.database.watch(cls)
+
         return cls
 
 class Model(with_metaclass(BaseModel)):
@@ -194,53 +251,51 @@ class Model(with_metaclass(BaseModel)):
     Represents a model in the database with all its fields and current values
     """
 
+    __slots__ = ("_values", "_related", "_deferred", "_dirty", "_snapshot",
+                 "__weakref__")
+
     def __init__(self, **kwargs):
-        # Map of all fields and associated values
-        self.dictValues = {}
-
-        # Initialize each field. If no value set it to None
-        for k, v in self._meta.fields.items():
-            if k in kwargs:
-                self.dictValues[k] = kwargs[k]
-                setattr(self, k, kwargs[k])
-            else:
-                self.dictValues[k] = None
-                setattr(self, k, None)
+        # Values of the fields, in the order of _meta.sorted_fields
+        self._values = [None]*len(self._meta.sorted_fields)
+
+        # Models set on foreign keys and lists of reverse relations. Created
+        # on first use
+        self._related = None
+
+        # Fields not loaded from the database. See SelectQuery.defer
+        self._deferred = None
 
-        # Set primary key to None if no value provided
-        if self._meta.primary_key and not "id" in self.dictValues:
-            self.dictValues["id"] = None
-            object.__setattr__(self, "id", None)
+        # Fields changed since the model was loaded or saved
+        self._dirty = None
 
-        # Initialize reverse relation as empty list.
-        for field in self._meta.reverse_rel:
-            object.__setattr__(self, field, [])
+        # Serialized JSON values, to find them changed in place. Taken on
+        # first read and once saved
+        self._snapshot = None
+
+        # Initialize each field given. Others stay None. Given fields are
+        # changed even if None, save() writes them
+        for field in self._meta.sorted_fields:
+            if field.name in kwargs:
+                setattr(self, field.name, kwargs[field.name])
+                field.changed(self)
 
         if self._meta.propagate and self._meta.database.subscribe:
             self._subscribe()
 
-    def __setattr__(self, name, value):
+    @property
+    def dictValues(self):
         """
-        Overide __setattr__ to update dict value and field value at once
+        Map of all fields and associated values. Foreign keys hold the
+        referenced value
         """
-        object.__setattr__(self, name, value)
-
-        if name in self.dictValues: # If updating a field value
-            if self._meta.fields[name].salt: # field is salt
-                # If field is already salt do nothing.
-                # XXX Could create a security issue. What happend is value
-                # starts with $2b$ but it's not encrypted. Not critical for now
-                if not ("$2b$" in value and value[:4] == "$2b$"):
-                    value = bcrypt.hashpw(value.encode('utf8'), bcrypt.gensalt())
-                    object.__setattr__(self, name, value)
+        return dict(zip(self._meta.sorted_fields_names, self._values))
 
-            # If value is an instance of model class and has a relation.
-            # Append it to the corresponding field list
-            if hasattr(value, "_meta") and self.isForeignKey(self._meta.fields[name]):
-                self.dictValues[name] = getattr(value, self._meta.fields[name].reference.name)
-                return
-
-            self.dictValues[name] = value
+    @property
+    def dirty_fields(self):
+        """
+        Names of the fields changed since the model was loaded or saved
+        """
+        return set(self._dirty or ())
 
     @classmethod
     def isForeignKey(cls, _field):
@@ -281,6 +336,14 @@ class Model(with_metaclass(BaseModel)):
             i+=1
 
         yield cls._meta.database.runOperation(init)
+        cls._meta.database.invalidate(cls)
+
+        # Notify the changes to the other processes. Rows are identified by
+        # their id, tables without one only notify each statement
+        if cls._meta.propagate or cls._meta.cache:
+            trigger = cls._meta.database.create_notify_trigger(cls._meta.table_name,
+                                        per_row=bool(cls._meta.propagate and cls._meta.primary_key))
+            yield cls._meta.database.runOperation(trigger)
 
     @classmethod
     @inlineCallbacks
@@ -290,33 +353,159 @@ class Model(with_metaclass(BaseModel)):
         """
         operation = cls._meta.database.delete_table(cls._meta.table_name)
         yield cls._meta.database.runOperation(operation)
+        cls._meta.database.invalidate(cls)
 
     @classmethod
     @inlineCallbacks
-    def insert(cls, values):
+    def insert(cls, values, transaction=None):
         """
         Insert a row to the table with the given values
         """
-        result = yield InsertQuery(cls, values).execute()
+        result = yield InsertQuery(cls, values).in_transaction(transaction).execute()
         returnValue(result)
 
     @classmethod
     @inlineCallbacks
-    def update(cls, values):
+    def bulk_insert(cls, rows, batch_size=1000, transaction=None):
+        """
+        Insert several rows with one multi-row INSERT per batch. Rows are
+        either dicts of values (sent as is, like insert) or model instances.
+        Returns the list of ids in order. Instances get their id set.
+        """
+        rows = list(rows)
+        yield defer.gatherResults([row._hash_salted() for row in rows if isinstance(row, Model)])
+
+        if transaction is not None:
+            for row in rows:
+                if isinstance(row, Model):
+                    transaction.track(row)
+
+        values = []
+        for row in rows:
+            if isinstance(row, Model):
+                row = {key : cls._meta.fields[key].insert_format(value) for key, value in row.dictValues.items()}
+                if cls._meta.primary_key:
+                    del row["id"]
+            values.append(row)
+
+        ids = yield BulkInsertQuery(cls, values, batch_size).in_transaction(transaction).execute()
+
+        for row, pk in zip(rows, ids):
+            if isinstance(row, Model):
+                if cls._meta.primary_key:
+                    row.id = pk
+                    if cls._meta.propagate and cls._meta.database.subscribe:
+                        row._subscribe()
+                row._dirty = None
+                row._take_snapshot()
+
+        returnValue(ids)
+
+    @classmethod
+    @inlineCallbacks
+    def bulk_update(cls, instances, fields=None, batch_size=1000, transaction=None):
+        """
+        Update several rows with one UPDATE ... FROM (VALUES ...) per batch.
+        fields are the fields to update, by default those changed on any of
+        the instances. Returns the number of rows updated
+        """
+        if not cls._meta.primary_key:
+            raise Exception("ERROR: Not primary key cannot bulk update rows")
+
+        instances = list(instances)
+        for instance in instances:
+            instance._check_snapshot()
+
+        if fields is None:
+            names = set()
+            for instance in instances:
+                names.update(instance._dirty or ())
+        else:
+            names = set([getattr(x, "name", x) for x in fields])
+
+        # The id identifies the row, it is not updated
+        names.discard(PrimaryKeyField.name)
+        columns = [x for x in cls._meta.sorted_fields if x.name in names]
+        if not columns or not instances:
+            returnValue(0)
+
+        for instance in instances:
+            if not instance.id:
+                raise Exception("ERROR: Cannot bulk update a row not saved")
+            if instance._deferred and instance._deferred & names:
+                raise Exception("ERROR: Fields {0} were not loaded"
+                                .format(", ".join(instance._deferred & names)))
+
+        yield defer.gatherResults([x._hash_salted() for x in instances])
+
+        if transaction is not None:
+            for instance in instances:
+                transaction.track(instance)
+
+        rows = [[x.id] + [field.insert_format(x._values[field.index]) for field in columns]
+                for x in instances]
+        count = yield (BulkUpdateQuery(cls, rows, columns, batch_size)
+                       .in_transaction(transaction).execute())
+
+        # Updated fields are saved
+        for instance in instances:
+            if instance._dirty:
+                instance._dirty -= names
+            instance._take_snapshot(names)
+
+        returnValue(count)
+
+    @classmethod
+    def copy_from(cls, rows, columns=None, format="text", chunk_size=65536):
+        """
+        Stream rows (dicts or instances) into the table using COPY FROM STDIN.
+        Values are serialized with each field insert_format. Rows are read
+        chunk_size bytes at a time so rows can come from any generator.
+        Returns a Deferred firing with the number of rows copied.
+        """
+        if columns is None:
+            columns = [name for name in cls._meta.sorted_fields_names
+                       if not (cls._meta.primary_key and name == PrimaryKeyField.name)]
+        else:
+            columns = [getattr(x, "name", x) for x in columns]
+
+        salted = [cls._meta.fields[name] for name in columns if cls._meta.fields[name].salt]
+        if salted:
+            rows = cls._hashed_rows(rows, salted)
+
+        return cls._meta.database.copy_from(cls, rows, columns, format, chunk_size)
+
+    @staticmethod
+    def _hashed_rows(rows, salted):
+        """
+        Rows as dicts with their salted fields hashed. Rows are pulled by
+        the COPY thread, so hashing does not block the reactor
+        """
+        for row in rows:
+            row = dict(row.dictValues if isinstance(row, Model) else row)
+            for field in salted:
+                value = row.get(field.name)
+                if value is not None and not hashing.is_hashed(value):
+                    row[field.name] = hashing.hash_value(value)
+            yield row
+
+    @classmethod
+    @inlineCallbacks
+    def update(cls, values, transaction=None):
         """
         Update values in row
         """
-        result = yield UpdateQuery(cls, values).execute()
+        result = yield UpdateQuery(cls, values).in_transaction(transaction).execute()
         returnValue(result)
 
     @classmethod
     @inlineCallbacks
-    def create(cls, **kwargs):
+    def create(cls, transaction=None, **kwargs):
         """
         Instanciates a model class object and save it into the database.
         """
         inst = cls(**kwargs)
-        yield inst.save()
+        yield inst.save(transaction)
         returnValue(inst)
 
     @classmethod
@@ -328,16 +517,20 @@ class Model(with_metaclass(BaseModel)):
 
     @classmethod
     @inlineCallbacks
-    def add(cls, obj1, obj2):
+    def add(cls, obj1, obj2, transaction=None):
         """
         Add a link between two model
         """
         if not cls._meta.many_to_many:
             raise Exception("ERROR: Add called on non many to many model")
 
-        query = AddQuery(cls, obj1, obj2)
+        query = AddQuery(cls, obj1, obj2).in_transaction(transaction)
         yield query.execute()
 
+        if transaction is not None:
+            transaction.track(obj1)
+            transaction.track(obj2)
+
         if not getattr(obj1, obj2._meta.name):
             setattr(obj1, obj2._meta.name, [obj2])
         else:
@@ -350,16 +543,20 @@ class Model(with_metaclass(BaseModel)):
 
     @classmethod
     @inlineCallbacks
-    def remove(cls, obj1, obj2):
+    def remove(cls, obj1, obj2, transaction=None):
         """
         Remove a link between two model
         """
         if not cls._meta.many_to_many:
             raise Exception("ERROR: Remove called on non many to many model")
 
-        query = RemoveQuery(cls, obj1, obj2)
+        query = RemoveQuery(cls, obj1, obj2).in_transaction(transaction)
         yield query.execute()
 
+        if transaction is not None:
+            transaction.track(obj1)
+            transaction.track(obj2)
+
         if obj2 in getattr(obj1, obj2._meta.name):
             getattr(obj1, obj2._meta.name).remove(obj2)
 
@@ -375,34 +572,137 @@ class Model(with_metaclass(BaseModel)):
         return query_instance
 
     @inlineCallbacks
-    def save(self):
+    def save(self, transaction=None):
         """
-        Save a row
+        Save a row. An existing row only gets its changed fields updated,
+        nothing is sent if none changed
         """
-        # For each field get the value to insert
-        values = {key : self._meta.fields[key].insert_format(value) for key, value in self.dictValues.items()}
-        if self._meta.primary_key:
-            # If an id exist then we should update
-            if self.id:
-                pk = yield self.update(values)
-                if self._meta.propagate:
-                    self._meta.database.propagate(self)
+        self._check_snapshot()
+        yield self._hash_salted()
+
+        database = transaction or self._meta.database
+        if transaction is not None:
+            transaction.track(self)
+
+        if self._meta.primary_key and self.id:
+            # The id identifies the row, it is not updated
+            changed = [self._meta.fields[name] for name in self._dirty or ()
+                       if name != PrimaryKeyField.name]
+            if not changed:
+                self._dirty = None
+                return
 
-            # Else it means we should create the row
-            else:
-                # XXX To Do: What happen if insert failed. What should we return
+            values = {field.name : field.insert_format(self._values[field.index]) for field in changed}
+            values["id"] = self.id
+
+            pk = yield self.update(values, transaction)
+            written = [field.name for field in changed]
+            if self._meta.propagate:
+                database.propagate(self, written)
+
+        else:
+            # For each field get the value to insert. Deferred fields were
+            # never loaded, their value is unknown
+            deferred = self._deferred or ()
+            values = {field.name : field.insert_format(value) for field, value in zip(self._meta.sorted_fields, self._values)
+                      if field.name not in deferred}
+
+            # XXX To Do: What happen if insert failed. What should we return
+            if self._meta.primary_key:
                 del values["id"]
-                pk = yield self.insert(values)
+            pk = yield self.insert(values, transaction)
+            written = None
 
-            # Update id value
+        # Update id value
+        if self._meta.primary_key:
             self.id = pk
-        else:
-            yield self.insert(values)
+            if self._meta.propagate and self._meta.database.subscribe:
+                self._subscribe()
+        self._dirty = None
+        self._take_snapshot(written)
+
+    def _check_snapshot(self):
+        """
+        Mark the JSON fields changed in place since loaded or saved
+        """
+        if self._snapshot:
+            for name in list(self._snapshot):
+                self._meta.fields[name].check(self)
+
+    def _take_snapshot(self, names=None):
+        """
+        Snapshot the JSON fields once written, all of them if no names given
+        """
+        for field in self._meta.sorted_fields:
+            if isinstance(field, fields.JsonField) and (names is None or field.name in names):
+                field.snapshot(self)
+
+    @inlineCallbacks
+    def _hash_salted(self):
+        """
+        Hash the salted fields holding a clear value, in the hashing thread
+        pool. The fields stay changed
+        """
+        salted = [x for x in self._meta.sorted_fields
+                  if x.salt and self._values[x.index] is not None
+                  and not hashing.is_hashed(self._values[x.index])]
+        if not salted:
+            return
+
+        hashes = yield defer.gatherResults([hashing.hash_password(self._values[x.index])
+                                            for x in salted])
+        for field, value in zip(salted, hashes):
+            self._values[field.index] = value
+
+    def check_password(self, field, candidate):
+        """
+        Check a clear value against a salted field, in the hashing thread
+        pool. Returns a Deferred firing with True if it matches
+        """
+        field = self._meta.fields[getattr(field, "name", field)]
+        value = self._values[field.index]
+        if value is None or not hashing.is_hashed(value):
+            return defer.succeed(False)
+
+        return hashing.check_password(candidate, value)
+
+    @inlineCallbacks
+    def load_deferred(self, *fields):
+        """
+        Load fields deferred when this model was selected. All of them if none
+        given
+        """
+        names = [getattr(x, "name", x) for x in fields] or list(self._deferred or ())
+        if not names:
+            return
+
+        if not self._meta.primary_key:
+            raise Exception("ERROR: Cannot load deferred fields without primary key")
+
+        query = yield (SelectQuery(self.__class__)
+                       .only(*[self._meta.fields[x] for x in names])
+                       .where(self._meta.fields["id"] == self.id)
+                       .execute())
+
+        # Loaded values are not changes
+        if query._total:
+            for name in names:
+                field = self._meta.fields[name]
+                self._values[field.index] = query[0]._values[field.index]
+                if self._deferred:
+                    self._deferred.discard(name)
 
     def _subscribe(self):
-        self._meta.database.connection.subscribe(self.propagate_update, u"wamp.postgresql.propagadate.{0}".format(self._meta.name))
+        # Instances are dispatched to by id. New ones are registered once
+        # saved
+        if self._meta.primary_key and self.id is not None:
+            self._meta.database.observe(self)
 
     def propagate_update(self, dictValues):
         if dictValues["id"] == self.id:
             for field, value in dictValues.iteritems():
                 self.__setattr__(field, value)
+                # Already saved by the sender
+                if self._dirty:
+                    self._dirty.discard(field)
+            self._take_snapshot(dictValues)
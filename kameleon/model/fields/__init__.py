@@ -22,6 +22,7 @@
 # SOFTWARE.
 ################################################################################
 
+from base import Count, Sum, Avg, Min, Max
 from booleanField import BooleanField
 from charField import CharField
 from dateField import DateField
@@ -35,4 +36,5 @@ from timestampField import TimestampField
 
 __all__ = [ "BooleanField", "CharField", "FloatField", "ForeignKeyField",
             "IntegerField", "JsonField", "PrimaryKeyField", "ReferenceField",
-            "TimestampField", "DateField"]
+            "TimestampField", "DateField", "Count", "Sum", "Avg", "Min",
+            "Max"]
@@ -144,6 +144,12 @@ class Node(object):
     def not_in(self, rhs):
         return Expression(self, OP.NOT_IN, rhs)
 
+    def asc(self):
+        return Ordering(self, 'ASC')
+
+    def desc(self):
+        return Ordering(self, 'DESC')
+
 class Field(Node):
     """
     A column on a table.
@@ -156,7 +162,7 @@ class Field(Node):
         # This field is unique in this table
         self.unique = unique
 
-        # This field should be encrypted using bcrypt
+        # This field should be encrypted using bcrypt. Hashed on save
         self.salt = salt
 
         # Column name
@@ -165,6 +171,9 @@ class Field(Node):
         # Field Model
         self.model_class = None
 
+        # Position of the value in the values of a model
+        self.index = None
+
     def get_db_field(self):
         if self.model_class._meta.database:
             return self.model_class._meta.database.TYPES[self.TYPE]
@@ -176,6 +185,39 @@ class Field(Node):
         self.model_class = model_class
         model_class._meta.add_field(self)
 
+    def parse(self):
+        return "{0}.{1}".format(self.model_class._meta.table_name, self.name), []
+
+    def signature(self):
+        return (self._node_type, self.model_class._meta.table_name, self.name), []
+
+    def __get__(self, instance, owner):
+        # Accessed on the model class, e.g `Model.field == 1`
+        if instance is None:
+            return self
+        return instance._values[self.index]
+
+    def __set__(self, instance, value):
+        # Salted values are hashed by Model.save(), out of the reactor thread
+
+        # A deferred field set by hand is now known, even if set to None
+        deferred = instance._deferred and self.name in instance._deferred
+        if deferred or value != instance._values[self.index]:
+            instance._values[self.index] = value
+            self.changed(instance)
+
+    def changed(self, instance):
+        """
+        Mark the field as changed on a model. Only changed fields are sent
+        by save()
+        """
+        if instance._dirty is None:
+            instance._dirty = set()
+        instance._dirty.add(self.name)
+
+        if instance._deferred:
+            instance._deferred.discard(self.name)
+
 class Expression(Node):
     """
     A binary expression, e.g `foo + 1` or `bar < 7`.
@@ -195,16 +237,126 @@ class Expression(Node):
         self.rhs = rhs
 
     def parse(self):
-        if isinstance(self.lhs, Field):
-            if isinstance(self.rhs, list):
-                _list = "', '".join(self.rhs)
-                return "{0}.{1} {2} ('{3}')".format(self.lhs.model_class._meta.table_name, self.lhs.name, self.op, _list)
-            elif self.rhs == None:
-                return "{0}.{1} {2} NULL".format(self.lhs.model_class._meta.table_name, self.lhs.name, self.op)
-            return "{0}.{1} {2} '{3}'".format(self.lhs.model_class._meta.table_name, self.lhs.name, self.op, self.rhs)
-        elif isinstance(self.lhs, Expression) and isinstance(self.rhs, Expression):
-            left = self.lhs.parse()
-            right = self.rhs.parse()
-            return "({0} {1} {2})".format(left, self.op, right)
-        else:
-            print("ERROR: Logic error")
+        """
+        Returns the SQL of the expression, with a %s placeholder for each
+        value, and the list of values to bind
+        """
+        lhs, params = parse_node(self.lhs)
+        op = OP_MAP.get(self.op, self.op)
+
+        if self.rhs is None and self.op in (OP.EQ, OP.NE, OP.IS, OP.IS_NOT):
+            op = "IS NOT" if self.op in (OP.NE, OP.IS_NOT) else "IS"
+            return "{0} {1} NULL".format(lhs, op), params
+
+        # A list is bound as one array so the SQL does not depend on its length
+        if self.op in (OP.IN, OP.NOT_IN) and isinstance(self.rhs, (list, tuple, set)):
+            op = "= ANY" if self.op == OP.IN else "<> ALL"
+            return "{0} {1}(%s)".format(lhs, op), params + [list(self.rhs)]
+
+        rhs, rhs_params = parse_node(self.rhs)
+        return "{0} {1} {2}".format(lhs, op, rhs), params + rhs_params
+
+    def signature(self):
+        """
+        Returns the shape of the expression and the values parse() binds.
+        Expressions with the same shape have the same SQL
+        """
+        lhs, params = node_signature(self.lhs)
+
+        if self.rhs is None and self.op in (OP.EQ, OP.NE, OP.IS, OP.IS_NOT):
+            return (self._node_type, self.op, lhs, None), params
+
+        if self.op in (OP.IN, OP.NOT_IN) and isinstance(self.rhs, (list, tuple, set)):
+            return (self._node_type, self.op, lhs, list), params + [list(self.rhs)]
+
+        rhs, rhs_params = node_signature(self.rhs)
+        return (self._node_type, self.op, lhs, rhs), params + rhs_params
+
+def parse_node(node):
+    """
+    SQL and values to bind of any part of an expression. Fields are column
+    names, other nodes parse themselves and anything else is a value
+    """
+    if isinstance(node, Expression):
+        sql, params = node.parse()
+        return "({0})".format(sql), params
+    elif isinstance(node, Node):
+        return node.parse()
+    return "%s", [node]
+
+def node_signature(node):
+    """
+    Shape and values to bind of any part of an expression, in the order of
+    parse_node()
+    """
+    if hasattr(node, "signature"):
+        return node.signature()
+    elif isinstance(node, Node):
+        sql, params = node.parse()
+        return (node._node_type, sql), params
+    return "%s", [node]
+
+class Ordering(Node):
+    """
+    A field with a sort direction, e.g `Model.date.desc()`.
+    """
+    _node_type = 'ordering'
+
+    def __init__(self, node, direction):
+        super(Ordering, self).__init__()
+
+        # Sorted field
+        self.node = node
+
+        # ASC or DESC
+        self.direction = direction
+
+    def parse(self):
+        node, params = parse_node(self.node)
+        return "{0} {1}".format(node, self.direction), params
+
+    def signature(self):
+        node, params = node_signature(self.node)
+        return (self._node_type, node, self.direction), params
+
+class Function(Node):
+    """
+    A SQL function applied to a field, e.g `Sum(Model.price)`.
+    """
+    _node_type = 'function'
+    NAME = None
+
+    def __init__(self, node=None):
+        super(Function, self).__init__()
+
+        # Argument of the function. None means all the rows (*)
+        self.node = node
+
+    def parse(self):
+        if self.node is None:
+            return "{0}(*)".format(self.NAME), []
+
+        node, params = parse_node(self.node)
+        return "{0}({1})".format(self.NAME, node), params
+
+    def signature(self):
+        if self.node is None:
+            return (self._node_type, self.NAME, None), []
+
+        node, params = node_signature(self.node)
+        return (self._node_type, self.NAME, node), params
+
+class Count(Function):
+    NAME = 'COUNT'
+
+class Sum(Function):
+    NAME = 'SUM'
+
+class Avg(Function):
+    NAME = 'AVG'
+
+class Min(Function):
+    NAME = 'MIN'
+
+class Max(Function):
+    NAME = 'MAX'
@@ -57,6 +57,34 @@ class ForeignKeyField(Field):
         reference = ReferenceField(self.model_class)
         reference.add_to_model(self.rel_model, self.related_name, self.name)
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        # The referenced model if one was set, else the stored value
+        if instance._related and self.name in instance._related:
+            return instance._related[self.name]
+        return instance._values[self.index]
+
+    def __set__(self, instance, value):
+        # Models are stored by their referenced value
+        if hasattr(value, "_meta"):
+            if instance._related is None:
+                instance._related = {}
+            instance._related[self.name] = value
+            value = getattr(value, self.reference.name)
+        elif instance._related:
+            instance._related.pop(self.name, None)
+
+        deferred = instance._deferred and self.name in instance._deferred
+        if deferred or value != instance._values[self.index]:
+            instance._values[self.index] = value
+            self.changed(instance)
+
+    def get_db_field(self):
+        # Same type as the referenced field
+        return self.reference.get_db_field()
+
     def create_field(self, name):
         _type = self.reference.get_db_field()
         field_string = "%s %s REFERENCES %s(%s)" %(self.name, _type, self.rel_model._meta.table_name, self.reference.name)
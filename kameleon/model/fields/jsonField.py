@@ -32,6 +32,40 @@ class JsonField(Field):
     def __init__(self, *args, **kwargs):
         super(JsonField, self).__init__(*args, **kwargs)
 
+    def __get__(self, instance, owner):
+        value = super(JsonField, self).__get__(instance, owner)
+
+        # Dicts and lists can be changed in place once read. Keep what they
+        # held, save() compares it to find them changed
+        if instance is not None and isinstance(value, (dict, list)):
+            if not (instance._snapshot and self.name in instance._snapshot) \
+               and not (instance._dirty and self.name in instance._dirty):
+                self.snapshot(instance)
+
+        return value
+
+    def snapshot(self, instance):
+        """
+        Keep the serialized value of the field on a model, see check
+        """
+        value = instance._values[self.index]
+        if isinstance(value, (dict, list)):
+            if instance._snapshot is None:
+                instance._snapshot = {}
+            instance._snapshot[self.name] = json.dumps(value, sort_keys=True)
+        elif instance._snapshot:
+            instance._snapshot.pop(self.name, None)
+
+    def check(self, instance):
+        """
+        Mark the field changed if its value differs from the snapshot, i.e
+        was changed in place
+        """
+        serialized = instance._snapshot.get(self.name) if instance._snapshot else None
+        if serialized is not None and \
+           json.dumps(instance._values[self.index], sort_keys=True) != serialized:
+            self.changed(instance)
+
     def create_field(self, name):
         field_string = ("{0} {1}"
                         .format(name,
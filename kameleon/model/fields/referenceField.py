@@ -44,6 +44,22 @@ class ReferenceField(Field):
 
         setattr(self.model_class, self.name, self)
 
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        # List of related models, created on first use
+        if instance._related is None:
+            instance._related = {}
+        if not self.name in instance._related:
+            instance._related[self.name] = []
+        return instance._related[self.name]
+
+    def __set__(self, instance, value):
+        if instance._related is None:
+            instance._related = {}
+        instance._related[self.name] = value
+
     def create_field(self, name):
         return ""
 
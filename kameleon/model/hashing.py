@@ -0,0 +1,93 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Hashing of salted fields with bcrypt. Hashing takes hundreds of
+milliseconds, so it runs in a thread pool instead of the reactor thread.
+"""
+
+import bcrypt
+
+from twisted.internet import threads
+from twisted.python.threadpool import ThreadPool
+
+# Maximum number of threads hashing at once
+POOL_SIZE = 4
+
+_pool = None
+
+def set_pool_size(size):
+    """
+    Set the maximum number of threads hashing at once
+    """
+    global POOL_SIZE
+    POOL_SIZE = size
+    if _pool is not None:
+        _pool.adjustPoolsize(maxthreads=size)
+
+def get_pool():
+    """
+    Thread pool used for hashing. Started on first use and stopped with the
+    reactor
+    """
+    global _pool
+    if _pool is None:
+        from twisted.internet import reactor
+
+        _pool = ThreadPool(minthreads=0, maxthreads=POOL_SIZE, name="kameleon-bcrypt")
+        _pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _pool.stop)
+    return _pool
+
+def is_hashed(value):
+    # XXX Could create a security issue. What happend is value starts with
+    # $2b$ but it's not encrypted. Not critical for now
+    return value[:4] == "$2b$"
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
+
+def hash_value(value):
+    """
+    bcrypt hash of value. Blocking, only call it out of the reactor thread
+    """
+    return bcrypt.hashpw(_encode(value), bcrypt.gensalt())
+
+def hash_password(value):
+    """
+    Returns a Deferred firing with the bcrypt hash of value
+    """
+    from twisted.internet import reactor
+
+    return threads.deferToThreadPool(reactor, get_pool(), hash_value, value)
+
+def check_password(candidate, hashed):
+    """
+    Returns a Deferred firing with True if candidate matches the hash
+    """
+    from twisted.internet import reactor
+
+    return threads.deferToThreadPool(reactor, get_pool(), bcrypt.checkpw,
+                                     _encode(candidate), _encode(hashed))
@@ -22,11 +22,11 @@
 # SOFTWARE.
 ################################################################################
 
-from insertQuery import InsertQuery
+from insertQuery import InsertQuery, BulkInsertQuery
 from selectQuery import SelectQuery
 from mTomQuery import AddQuery, RemoveQuery
-from updateQuery import UpdateQuery
+from updateQuery import UpdateQuery, BulkUpdateQuery
 from deleteQuery import DeleteQuery
 
-__all__ = [ "InsertQuery", "SelectQuery", "AddQuery",
-            "RemoveQuery", "UpdateQuery", "DeleteQuery"]
+__all__ = [ "InsertQuery", "BulkInsertQuery", "SelectQuery", "AddQuery",
+            "RemoveQuery", "UpdateQuery", "BulkUpdateQuery", "DeleteQuery"]
@@ -32,5 +32,14 @@ class Query(object):
         self.database = model_class._meta.database
         self._where = None
 
+    def in_transaction(self, transaction):
+        """
+        Run the query in transaction, see Database.transaction. None runs it
+        on its own
+        """
+        if transaction is not None:
+            self.database = transaction
+        return self
+
     def __repr__(self):
         return '%s' % (self.model_class)
@@ -22,6 +22,8 @@
 # SOFTWARE.
 ################################################################################
 
+import operator
+
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from base import Query
@@ -34,12 +36,44 @@ class DeleteQuery(Query):
     def __init__(self, model_class):
         super(DeleteQuery, self).__init__(model_class)
 
-    def where(self, *expression):
-        self._where = expression
+        # Fields of the deleted rows to return
+        self._returning = []
+
+    def where(self, *expressions):
+        """
+        Set the where clause. Expressions are ANDed, none deletes every row
+        """
+        self._where = reduce(operator.and_, expressions) if expressions else None
+        return self
+
+    def returning(self, *fields):
+        """
+        Return the deleted rows as models holding these fields
+        """
+        self._returning = list(fields)
         return self
 
+    def returned_fields(self):
+        return [x.name for x in self._returning]
+
     @inlineCallbacks
     def execute(self):
-        query = self.database.generate_delete(self)
-        yield self.database.runOperation(query)
-        returnValue(None)
+        query, params = self.database.generate_delete(self)
+        if not self._returning:
+            yield self.database.runOperation(query, params)
+            self.database.invalidate(self.model_class, cascade=True)
+            returnValue(None)
+
+        result = yield self.database.runQuery(query, params)
+        self.database.invalidate(self.model_class, cascade=True)
+
+        names = self.returned_fields()
+        deferred = set(self.model_class._meta.sorted_fields_names) - set(names)
+        models = []
+        for row in result:
+            model = self.model_class.from_row(row, names)
+            if deferred:
+                model._deferred = set(deferred)
+            models.append(model)
+
+        returnValue(models)
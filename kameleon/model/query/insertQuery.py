@@ -49,9 +49,58 @@ class InsertQuery(Query):
         # If return id. Use runQuery else use runOperation
         if self.return_id:
             result = yield self.database.runQuery(query, values)
+            self.database.invalidate(self.model_class)
             if result and self.model_class._meta.primary_key:
                 returnValue(result[0][0])
         else:
             yield self.database.runOperation(query, values)
+            self.database.invalidate(self.model_class)
 
         returnValue(None)
+
+class BulkInsertQuery(Query):
+    """
+    Object representing an insert of several rows. Rows are sent in batches,
+    each batch being a single multi-row INSERT statement.
+    """
+
+    def __init__(self, model_class, rows, batch_size=1000):
+        super(BulkInsertQuery, self).__init__(model_class)
+        # List of dict of values to insert
+        self.rows = rows
+
+        # Maximum number of rows per statement
+        self.batch_size = batch_size
+
+        # Columns inserted, in table order. Missing values are set to NULL
+        keys = set()
+        for row in rows:
+            keys.update(row.keys())
+        self.columns = [name for name in self.model_class._meta.sorted_fields_names
+                        if name in keys]
+
+        # XXX
+        self.on_conflict = self.model_class._meta.on_conflict
+
+        # If a model has a primary key then we will return the ids
+        self.return_id = self.model_class._meta.primary_key
+
+    @inlineCallbacks
+    def execute(self):
+        ids = []
+        if not self.columns:
+            returnValue(ids)
+
+        for start in range(0, len(self.rows), self.batch_size):
+            rows = self.rows[start:start + self.batch_size]
+            query, values = self.database.generate_bulk_insert(self, rows)
+
+            # If return id. Use runQuery else use runOperation
+            if self.return_id:
+                result = yield self.database.runQuery(query, values)
+                ids += [row[0] for row in result]
+            else:
+                yield self.database.runOperation(query, values)
+            self.database.invalidate(self.model_class)
+
+        returnValue(ids)
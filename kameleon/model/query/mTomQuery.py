@@ -42,8 +42,9 @@ class AddQuery(Query):
         # Execute only if the model is a middle table in a many to many
         # relation
         if self.model_class._meta.many_to_many:
-            query = self.database.generate_add(self)
-            yield self.database.runOperation(query)
+            query, params = self.database.generate_add(self)
+            yield self.database.runOperation(query, params)
+            self.database.invalidate(self.model_class)
         returnValue(None)
 
 class RemoveQuery(Query):
@@ -57,6 +58,7 @@ class RemoveQuery(Query):
         # Execute only if the model is a middle table in a many to many
         # relation
         if self.model_class._meta.many_to_many:
-            query = self.database.generate_remove(self)
-            yield self.database.runOperation(query)
+            query, params = self.database.generate_remove(self)
+            yield self.database.runOperation(query, params)
+            self.database.invalidate(self.model_class)
         returnValue(None)
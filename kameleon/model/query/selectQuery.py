@@ -22,11 +22,42 @@
 # SOFTWARE.
 ################################################################################
 
-import operator
+import base64, contextlib, gc, json, operator
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from base import Query
+from .. import hashing
+
+def encode_cursor(values):
+    """
+    Opaque token holding the key values of the last row of a page. Dates
+    are sent as ISO strings, the database casts them back.
+    """
+    def default(value):
+        if hasattr(value, "isoformat"):
+            return value.isoformat()
+        return str(value)
+
+    return base64.urlsafe_b64encode(json.dumps(values, default=default))
+
+def decode_cursor(token):
+    return json.loads(base64.urlsafe_b64decode(str(token)))
+
+@contextlib.contextmanager
+def gc_paused():
+    """
+    Disable the garbage collector while building many objects. Collections
+    triggered by the allocations cost more than the objects themselves and
+    nothing built is garbage
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
 
 class Join(object):
     """
@@ -58,6 +89,56 @@ class SelectQuery(Query):
         # Current table to use to join
         self._table_join = self.model_class
 
+        # List of orderings
+        self._order_by = []
+
+        # Maximum number of rows returned
+        self._limit = None
+
+        # Number of rows skipped
+        self._offset = None
+
+        # Orderings of the fields used for keyset pagination
+        self._keyset = []
+
+        # Key values of the row to start after
+        self._after = None
+
+        # Token to pass to after() to get the next page. None on last page
+        self.next_cursor = None
+
+        # Fields to select. If empty every field is selected
+        self._only = []
+
+        # Fields not to select
+        self._defer = []
+
+        # Fields to group by when aggregating
+        self._group_by = []
+
+        # Related models loaded with one query each after the select
+        self._prefetch = []
+
+        # How rows are returned: models, or tuples, dicts or scalars straight
+        # from the driver
+        self._result_mode = None
+
+        # Field returned in scalars mode
+        self._scalar = None
+
+        # Values to set when the query is an update. See update()
+        self._update = None
+
+        # Fields returned by an update or a delete
+        self._returning = []
+
+        # Seconds the rows are kept in the result cache. None uses the cache
+        # option of the model
+        self._cache_ttl = None
+
+        # Session which instances are returned. See Session.query
+        self._session = None
+
     def where(self, *expressions):
         """
         Set the where clause
@@ -65,6 +146,161 @@ class SelectQuery(Query):
         self._where = reduce(operator.and_, expressions)
         return self
 
+    def only(self, *fields):
+        """
+        Select only these fields. Fields of joined models can be given too.
+        The primary key is always selected so deferred fields can be loaded
+        """
+        self._only = list(fields)
+        return self
+
+    def defer(self, *fields):
+        """
+        Do not select these fields. They can be loaded later on each model
+        using load_deferred()
+        """
+        self._defer = list(fields)
+        return self
+
+    def selected_fields(self, model_class):
+        """
+        Names of the fields selected for a model of the query, in table order
+        """
+        names = model_class._meta.sorted_fields_names
+        if not self._only and not self._defer:
+            return names
+
+        # Fields needed whatever the projection
+        required = [x.node.name for x in self._keyset]
+        if model_class._meta.primary_key:
+            required.append("id")
+
+        only = [x.name for x in self._only if x.model_class == model_class]
+        if only:
+            names = [x for x in names if x in only or x in required]
+
+        defer = [x.name for x in self._defer if x.model_class == model_class]
+        return [x for x in names if x not in defer or x in required]
+
+    def deferred_fields(self, model_class):
+        """
+        Names of the fields of a model not selected by the query
+        """
+        selected = self.selected_fields(model_class)
+        return set([x for x in model_class._meta.sorted_fields_names if x not in selected])
+
+    def order_by(self, *fields):
+        """
+        Set the order of the rows. Fields are sorted ascending unless given
+        as `Model.field.desc()`
+        """
+        self._order_by = [x if hasattr(x, "direction") else x.asc() for x in fields]
+        return self
+
+    def limit(self, limit):
+        """
+        Set the maximum number of rows returned. With joins it limits joined
+        rows, not models.
+        """
+        self._limit = limit
+        return self
+
+    def offset(self, offset):
+        """
+        Set the number of rows skipped
+        """
+        self._offset = offset
+        return self
+
+    def paginate_by(self, key_fields, page_size):
+        """
+        Keyset pagination. Rows are sorted by key_fields, which together must
+        be unique, e.g `(Model.ts, Model.id)`. Once executed, next_cursor holds
+        the token to give to after() to get the following page.
+        """
+        if not isinstance(key_fields, (list, tuple)):
+            key_fields = [key_fields]
+
+        self._keyset = [x if hasattr(x, "direction") else x.asc() for x in key_fields]
+        if len(set([x.direction for x in self._keyset])) > 1:
+            raise Exception("ERROR: Keyset fields must all be sorted in the same direction")
+
+        for ordering in self._keyset:
+            if ordering.node.model_class != self.model_class:
+                raise Exception("ERROR: Keyset fields must belong to {0}"
+                                .format(self.model_class._meta.name))
+
+        self._order_by = self._keyset
+        self._limit = page_size
+        return self
+
+    def after(self, field_values):
+        """
+        Start after the row having these key values. Takes either a tuple of
+        values, in the order of the keyset fields, or a next_cursor token
+        """
+        if isinstance(field_values, basestring):
+            field_values = decode_cursor(field_values)
+
+        self._after = list(field_values)
+        return self
+
+    def group_by(self, *fields):
+        """
+        Group rows by these fields when aggregating
+        """
+        self._group_by = list(fields)
+        return self
+
+    @inlineCallbacks
+    def count(self, approximate=False):
+        """
+        Number of rows matching the query, computed by the database. With
+        approximate, the planner estimate is used instead. It is cheap on
+        huge tables but can be far off if statistics are old
+        """
+        if approximate:
+            if self._where or self._joins or self._after is not None:
+                computedQuery, params = self.database.generate_select(self)
+                result = yield self.database.runQuery("EXPLAIN (FORMAT JSON) " + computedQuery,
+                                                      params)
+                if result:
+                    returnValue(int(result[0][0][0]["Plan"]["Plan Rows"]))
+            else:
+                computedQuery, params = self.database.generate_approximate_count(self)
+                result = yield self.database.runQuery(computedQuery, params)
+                # Table never analyzed. Fall back to an exact count
+                if result and result[0][0] >= 0:
+                    returnValue(result[0][0])
+
+        computedQuery, params = self.database.generate_count(self)
+        result = yield self._run_query(computedQuery, params)
+        returnValue(result[0][0] if result else 0)
+
+    @inlineCallbacks
+    def exists(self):
+        """
+        Does at least one row match the query
+        """
+        computedQuery, params = self.database.generate_exists(self)
+        result = yield self._run_query(computedQuery, params)
+        returnValue(bool(result and result[0][0]))
+
+    @inlineCallbacks
+    def aggregate(self, *aggregates):
+        """
+        Compute aggregates, e.g `Sum(Model.price)`, in the database. Returns a
+        tuple of values, or with group_by a list of tuples starting with the
+        values of the grouped fields
+        """
+        computedQuery, params = self.database.generate_aggregate(self, aggregates)
+        result = yield self._run_query(computedQuery, params)
+
+        if self._group_by:
+            returnValue([tuple(row) for row in result])
+
+        returnValue(tuple(result[0]) if result else (None,)*len(aggregates))
+
     def switch(self, dest):
         """
         Switch the current table for the next join
@@ -82,6 +318,126 @@ class SelectQuery(Query):
         self._table_join = dest
         return self
 
+    def tuples(self):
+        """
+        Return rows as tuples, in the order of the selected columns, instead
+        of models
+        """
+        self._result_mode = "tuples"
+        return self
+
+    def dicts(self):
+        """
+        Return rows as dicts instead of models. Columns of joined models are
+        named table.column
+        """
+        self._result_mode = "dicts"
+        return self
+
+    def scalars(self, field):
+        """
+        Return the list of values of one field instead of models
+        """
+        self._result_mode = "scalars"
+        self._scalar = field
+        # Fields overload ==, compare them by identity
+        if not any(x is field for x in self._only):
+            self._only.append(field)
+        return self
+
+    def prefetch(self, *models):
+        """
+        Load related models with one query per model instead of joining
+        them. Each model is related to the queried model, or to a model
+        prefetched before it, e.g `Author.all().prefetch(Book, Review)`
+        """
+        self._prefetch = list(models)
+        return self
+
+    @inlineCallbacks
+    def _prefetch_related(self, results):
+        loaded = [(self.model_class, results)]
+        for model_class in self._prefetch:
+            # Closest model already loaded related to this one
+            for parent_class, parents in reversed(loaded):
+                if model_class in parent_class._meta.rel_class:
+                    break
+            else:
+                raise Exception("ERROR: {0} is not related to {1}"
+                                .format(model_class._meta.name, self.model_class._meta.name))
+
+            field = parent_class._meta.rel_class[model_class]
+            if parent_class.isReferenceField(field):
+                # The prefetched models hold a foreign key to the parents
+                fk = model_class._meta.rel_class[parent_class]
+                key, column = fk.reference.name, fk.name
+            else:
+                # The parents hold a foreign key to the prefetched models
+                fk = field
+                key, column = fk.name, fk.reference.name
+
+            by_key = {}
+            index = parent_class._meta.fields[key].index
+            for parent in parents:
+                if parent._values[index] is not None:
+                    by_key.setdefault(parent._values[index], []).append(parent)
+
+            children = []
+            if by_key:
+                query = (model_class.all()
+                         .where(model_class._meta.fields[column] << list(by_key)))
+                query._cache_ttl = self._cache_ttl
+                query._session = self._session
+                yield query.execute()
+                children = query._results
+
+            # Instances of a session may hold lists filled by other queries
+            if self._session is not None:
+                if fk is field:
+                    owners, name = children, fk.related_name
+                else:
+                    owners, name = parents, field.name
+                for owner in owners:
+                    if owner._related:
+                        owner._related.pop(name, None)
+
+            index = model_class._meta.fields[column].index
+            for child in children:
+                for parent in by_key.get(child._values[index], []):
+                    if fk is field:
+                        setattr(parent, fk.name, child)
+                        getattr(child, fk.related_name).append(parent)
+                    else:
+                        getattr(parent, field.name).append(child)
+                        setattr(child, fk.name, parent)
+
+            loaded.append((model_class, children))
+
+    def cached(self, ttl=60):
+        """
+        Keep the rows of this query in the result cache for ttl seconds. They
+        are dropped as soon as one of the tables read is written. A ttl of 0
+        disables the cache for a model cached through its Meta
+        """
+        self._cache_ttl = ttl
+        return self
+
+    def _run_query(self, computedQuery, params):
+        """
+        Run a select, through the result cache if the query or its model
+        is cached
+        """
+        ttl = self._cache_ttl
+        if ttl is None:
+            ttl = self.model_class._meta.cache
+
+        if not ttl or self._delete or self._update is not None:
+            return self.database.runQuery(computedQuery, params)
+
+        tables = [self.model_class._meta.table_name]
+        tables += [x.dest._meta.table_name for x in self._joins]
+        return self.database.runCachedQuery(tables, ttl, computedQuery, params)
+
     def delete(self):
         """
         Set this query as a delete query
@@ -89,27 +445,172 @@ class SelectQuery(Query):
         self._delete = True
         return self
 
+    def update(self, **values):
+        """
+        Set this query as an update of the matching rows, done in a single
+        statement. Values are either values or expressions using the
+        fields, e.g `update(counter=Model.counter + 1)`
+        """
+        for name in values:
+            if not name in self.model_class._meta.fields:
+                raise Exception("ERROR: Unknown field {0} on model {1}"
+                                .format(name, self.model_class._meta.name))
+
+        self._update = values
+        return self
+
+    def returning(self, *fields):
+        """
+        Fields of the rows changed by an update or a delete to return. The
+        id by default
+        """
+        self._returning = list(fields)
+        return self
+
+    def returned_fields(self):
+        """
+        Names of the fields returned by an update or a delete
+        """
+        if self._returning:
+            return [x.name for x in self._returning]
+        if self.model_class._meta.primary_key:
+            return ["id"]
+        return []
+
+    @inlineCallbacks
+    def _update_values(self):
+        """
+        Pairs of field and value to set, values being formatted like on
+        insert. Salted fields are hashed in the hashing thread pool
+        """
+        values = []
+        for name, value in self._update.items():
+            field = self.model_class._meta.fields[name]
+            if hasattr(value, "_meta"):
+                value = getattr(value, field.reference.name)
+            elif field.salt and value is not None and not hashing.is_hashed(value):
+                value = yield hashing.hash_password(value)
+            elif not hasattr(value, "parse"):
+                value = field.insert_format(value)
+            values.append((field, value))
+
+        returnValue(values)
+
     @inlineCallbacks
     def execute(self):
         """
         Execute query
         """
         # Generate Query
-        computedQuery = self.database.generate_select(self)
+        if self._delete or self._update is not None:
+            if self._joins or self._limit is not None or self._offset:
+                raise Exception("ERROR: Update and delete do not support joins, limit or offset")
+
+        # Row looked up by id already held by the session
+        if self._session is not None:
+            model = self._session.lookup(self)
+            if model is not None:
+                self._results = [model]
+                self._total = 1
+                self.next_cursor = None
+                returnValue(self)
+
+        if self._update is not None:
+            values = yield self._update_values()
+            computedQuery, params = self.database.generate_set_update(self, values)
+        else:
+            computedQuery, params = self.database.generate_select(self)
 
         # Run query
-        result = yield self.database.runQuery(computedQuery)
+        result = yield self._run_query(computedQuery, params)
+        if self._delete:
+            self.database.invalidate(self.model_class, cascade=True)
+        elif self._update is not None:
+            self.database.invalidate(self.model_class)
 
         # Parse result
-        self._results = self.database.parse_select(self, result)
+        with gc_paused():
+            self._results = self.database.parse_select(self, result)
         self._total = len(self._results)
+
+        if self._prefetch and not self._delete and self._update is None and not self._result_mode:
+            yield self._prefetch_related(self._results)
+
+        # Token of the next page if this one is full. Keyset fields are
+        # always selected, in the columns of the queried model
+        if self._keyset and self._results and len(result) >= self._limit:
+            columns = self.selected_fields(self.model_class)
+            self.next_cursor = encode_cursor([result[-1][columns.index(x.node.name)]
+                                              for x in self._keyset])
+        else:
+            self.next_cursor = None
+
         returnValue(self)
 
+    def stream(self, callback, chunk_size=1000):
+        """
+        Read the result through a server-side cursor. callback is called with
+        each batch of at most chunk_size models. If it returns a Deferred, the
+        next batch is fetched once it fired. The cursor holds a connection of
+        its own until the end, opened for it if the database is not pooled,
+        so callback can run queries. Returns a Deferred firing with the number
+        of rows read.
+        """
+        if self._joins:
+            raise Exception("ERROR: Stream does not support joins")
+
+        computedQuery, params = self.database.generate_select(self)
+        return self.database.runStream(self._stream, computedQuery, params,
+                                       callback, chunk_size)
+
+    @inlineCallbacks
+    def _stream(self, cursor, computedQuery, params, callback, chunk_size):
+        name = "kameleon_{0}".format(self.model_class._meta.table_name)
+        yield cursor.execute("DECLARE {0} NO SCROLL CURSOR FOR {1}"
+                             .format(name, computedQuery.rstrip(";")), params)
+
+        total = 0
+        while True:
+            yield cursor.execute("FETCH FORWARD {0} FROM {1}".format(chunk_size, name))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+
+            total += len(rows)
+            with gc_paused():
+                models = self.database.parse_select(self, rows)
+            yield callback(models)
+
+            if len(rows) < chunk_size:
+                break
+
+        yield cursor.execute("CLOSE {0}".format(name))
+        returnValue(total)
+
     def __iter__(self):
         return iter(self._results)
 
     # If value bigger than number of objects, return the last object of the list
     def __getitem__(self, index):
+        if isinstance(index, slice):
+            if self._results is not None:
+                return self._results[index]
+
+            # Not executed yet. Push the slice down to the query
+            start = index.start or 0
+            if index.step is not None or start < 0 or (index.stop is not None and index.stop < 0):
+                raise Exception("ERROR: Only positive slices without step can be used on a query")
+
+            if self._limit is not None:
+                stop = self._limit if index.stop is None else min(index.stop, self._limit)
+            else:
+                stop = index.stop
+
+            self._offset = (self._offset or 0) + start
+            if stop is not None:
+                self._limit = max(stop - start, 0)
+            return self
+
         if self._total <= 0:
             return []
         elif index >= self._total:
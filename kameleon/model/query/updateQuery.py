@@ -44,9 +44,41 @@ class UpdateQuery(Query):
         # If return id. Use runQuery else use runOperation
         if self.return_id:
             result = yield self.database.runQuery(query, values)
+            self.database.invalidate(self.model_class)
             if result and self.model_class._meta.primary_key:
                 returnValue(result[0][0])
         else:
             yield self.database.runOperation(query, values)
+            self.database.invalidate(self.model_class)
 
         returnValue(None)
+
+class BulkUpdateQuery(Query):
+    """
+    Object representing an update of several rows. Rows are sent in batches,
+    each batch being a single UPDATE ... FROM (VALUES ...) statement.
+    """
+
+    def __init__(self, model_class, rows, fields, batch_size=1000):
+        super(BulkUpdateQuery, self).__init__(model_class)
+        # List of rows. Each is the id followed by the values of fields
+        self.rows = rows
+
+        # Fields updated
+        self.fields = fields
+
+        # Maximum number of rows per statement
+        self.batch_size = batch_size
+
+    @inlineCallbacks
+    def execute(self):
+        count = 0
+        for start in range(0, len(self.rows), self.batch_size):
+            rows = self.rows[start:start + self.batch_size]
+            query, values = self.database.generate_bulk_update(self, rows)
+
+            result = yield self.database.runQuery(query, values)
+            self.database.invalidate(self.model_class)
+            count += len(result)
+
+        returnValue(count)
@@ -0,0 +1,254 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from fields import PrimaryKeyField
+from fields.base import OP
+from query import SelectQuery, BulkInsertQuery, BulkUpdateQuery
+
+class Session(object):
+    """
+    Unit of work keeping a single instance per row. Queries made through the
+    session return the instances it already holds, and flush() writes the
+    new and changed instances with batched statements in one transaction.
+    """
+
+    def __init__(self, batch_size=1000):
+        # Instance of each row, by model class and id
+        self.identity = {}
+
+        # Instances to insert on flush, in the order they were added
+        self.new = collections.OrderedDict()
+
+        # Maximum number of rows per statement on flush
+        self.batch_size = batch_size
+
+    def query(self, model_class):
+        """
+        Select query which rows are the instances of the session
+        """
+        query = SelectQuery(model_class)
+        query._session = self
+        return query
+
+    def get(self, model_class, id):
+        """
+        Instance of the row with this id, None if it does not exist. Only
+        queried if the session does not hold it already
+        """
+        model = self.identity.get((model_class, id))
+        if model is not None:
+            return defer.succeed(model)
+
+        d = self.query(model_class).where(model_class.id == id).execute()
+        d.addCallback(lambda query: query._results[0] if query._results else None)
+        return d
+
+    def lookup(self, query):
+        """
+        Instance held by the session if query only looks a row up by id
+        """
+        where = query._where
+        if (query._joins or query._only or query._defer or query._prefetch or
+                query._result_mode or query._after is not None or query._delete or
+                query._update is not None or getattr(where, "op", None) != OP.EQ):
+            return None
+
+        lhs, rhs = where.lhs, where.rhs
+        if (getattr(lhs, "name", None) != PrimaryKeyField.name or
+                getattr(lhs, "model_class", None) is not query.model_class or
+                hasattr(rhs, "parse")):
+            return None
+
+        model = self.identity.get((query.model_class, rhs))
+        if model is None or model._deferred:
+            return None
+        return model
+
+    def merge(self, model):
+        """
+        Instance of the row of model in the session. model is added if the
+        session does not hold its row yet, else the fields it loaded are
+        copied to the held instance if that one did not load them
+        """
+        if not model._meta.primary_key or model.id is None:
+            return model
+
+        key = (type(model), model.id)
+        known = self.identity.get(key)
+        if known is None:
+            self.identity[key] = model
+            return model
+
+        if known is not model and known._deferred:
+            for name in list(known._deferred):
+                if not model._deferred or name not in model._deferred:
+                    index = model._meta.fields[name].index
+                    known._values[index] = model._values[index]
+                    known._deferred.discard(name)
+        return known
+
+    def add(self, model):
+        """
+        Add an instance to the session. Unsaved ones are inserted on flush
+        """
+        if model._meta.primary_key and model.id is not None:
+            if self.merge(model) is not model:
+                raise Exception("ERROR: Another instance of {0} {1} is in the session"
+                                .format(model._meta.name, model.id))
+        else:
+            self.new[id(model)] = model
+        return model
+
+    def __contains__(self, model):
+        if id(model) in self.new:
+            return True
+        return self.identity.get((type(model), getattr(model, "id", None))) is model
+
+    def changed(self):
+        """
+        Instances of the session with fields changed since loaded or saved
+        """
+        for model in self.identity.values():
+            model._check_snapshot()
+
+        return [x for x in self.identity.values()
+                if x._dirty and x._dirty - set([PrimaryKeyField.name])]
+
+    @inlineCallbacks
+    def flush(self):
+        """
+        Insert the new instances, parents first, and update the changed ones
+        with one statement per model and batch. Everything is written in a
+        single transaction, retried like any transaction
+        """
+        new = list(self.new.values())
+        changed = self.changed()
+        if not new and not changed:
+            returnValue(None)
+
+        databases = set([x._meta.database for x in new + changed])
+        if len(databases) > 1:
+            raise Exception("ERROR: Cannot flush models of several databases")
+        database = databases.pop()
+
+        yield defer.gatherResults([x._hash_salted() for x in new + changed])
+
+        try:
+            updated = yield database.transaction(self._write, new, changed)
+        except Exception:
+            # Ids were given by a transaction rolled back
+            for model in new:
+                if model._meta.primary_key:
+                    model.id = None
+            raise
+
+        for model in new:
+            model._dirty = None
+            model._take_snapshot()
+            if model._meta.primary_key:
+                self.identity[(type(model), model.id)] = model
+                if model._meta.propagate and database.subscribe:
+                    model._subscribe()
+        self.new.clear()
+
+        for model, names in updated:
+            model._dirty -= names
+            model._take_snapshot(names)
+            if model._meta.propagate:
+                database.propagate(model, list(names))
+
+    @inlineCallbacks
+    def _write(self, transaction, new, changed):
+        for model_class in self._insert_order(new):
+            models = [x for x in new if type(x) is model_class]
+            rows = []
+            for model in models:
+                self._resolve(model)
+                rows.append({field.name : field.insert_format(model._values[field.index])
+                             for field in model_class._meta.sorted_fields
+                             if not (model_class._meta.primary_key and field.name == PrimaryKeyField.name)})
+
+            ids = yield (BulkInsertQuery(model_class, rows, self.batch_size)
+                         .in_transaction(transaction).execute())
+            for model, pk in zip(models, ids):
+                model.id = pk
+
+        # Changed instances of a model are updated together if the same
+        # fields changed
+        groups = collections.OrderedDict()
+        for model in changed:
+            self._resolve(model)
+            names = frozenset(model._dirty - set([PrimaryKeyField.name]))
+            groups.setdefault((type(model), names), []).append(model)
+
+        updated = []
+        for (model_class, names), models in groups.items():
+            columns = [x for x in model_class._meta.sorted_fields if x.name in names]
+            rows = [[x.id] + [field.insert_format(x._values[field.index]) for field in columns]
+                    for x in models]
+
+            yield (BulkUpdateQuery(model_class, rows, columns, self.batch_size)
+                   .in_transaction(transaction).execute())
+            updated += [(x, names) for x in models]
+
+        returnValue(updated)
+
+    def _resolve(self, model):
+        """
+        Set the foreign keys holding a model to its referenced value, which
+        may have been given by this flush
+        """
+        if not model._related:
+            return
+
+        for name, field in model._meta.rel.items():
+            related = model._related.get(name)
+            if related is not None:
+                setattr(model, name, related)
+
+    def _insert_order(self, models):
+        """
+        Classes of models, each after the classes it references
+        """
+        classes = []
+        for model in models:
+            if type(model) not in classes:
+                classes.append(type(model))
+
+        ordered = []
+        def visit(model_class, path):
+            if model_class in ordered or model_class in path:
+                return
+            for field in model_class._meta.rel.values():
+                if field.rel_model in classes:
+                    visit(field.rel_model, path + [model_class])
+            ordered.append(model_class)
+
+        for model_class in classes:
+            visit(model_class, [])
+        return ordered